@@ -1,22 +1,28 @@
+import asyncio
 import logging
-import hashlib
 import hmac
-from urllib.parse import parse_qs
-from typing import Optional, List
-from uuid import UUID
-
-from fastapi import APIRouter, HTTPException, Depends, Header, Query
-from fastapi.middleware.cors import CORSMiddleware
+import secrets
+from urllib.parse import unquote_plus
+from typing import Annotated, Optional, List
+
+import orjson
+from aiogram.types import LabeledPrice
+from cachetools import TTLCache
+from fastapi import APIRouter, HTTPException, Depends, Header, Path, Query, Request, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from .config import settings
 from .db.models import (
     Note, NoteCreate, NoteUpdate, SearchQuery, SearchResult, StatsResponse, 
-    PublicNote, FTSSearchResult, ShareResponse, SubscriptionInfo, SubscriptionLimits,
+    PublicNote, FTSSearchResult, HybridSearchResult, ShareResponse, SubscriptionInfo, SubscriptionLimits,
     UsageStats, InvoiceRequest, InvoiceResponse, LanguageUpdate
 )
 from .services.notes_service import NotesService
 from .services.rag_service import RAGService
+from .services.usage_buffer import usage_buffer
 
 logger = logging.getLogger(__name__)
 
@@ -29,7 +35,7 @@ def set_bot_instance(bot):
     _bot_instance = bot
 
 # Create router instead of app
-router = APIRouter(prefix="/api", tags=["api"])
+router = APIRouter(prefix="/api", tags=["api"], default_response_class=ORJSONResponse)
 
 # Services
 notes_service = NotesService()
@@ -37,6 +43,28 @@ rag_service = RAGService()
 
 
 # Telegram WebApp auth
+# Secret key depends only on the bot token, so derive it once per process
+_TG_SECRET_KEY = hmac.digest(b"WebAppData", settings.telegram_bot_token.encode(), "sha256")
+
+
+def _parse_init_data(init_data: str) -> dict[str, str]:
+    """
+    Single-pass parser for the flat init data query string.
+    
+    Equivalent to parse_qs for this input shape (first value wins, blank
+    values dropped) without building a list per field.
+    """
+    fields = {}
+    for pair in init_data.split("&"):
+        key, sep, value = pair.partition("=")
+        if not sep or not value:
+            continue
+        key = unquote_plus(key)
+        if key not in fields:
+            fields[key] = unquote_plus(value)
+    return fields
+
+
 def validate_telegram_init_data(init_data: str) -> Optional[dict]:
     """
     Validate Telegram WebApp init data.
@@ -48,43 +76,33 @@ def validate_telegram_init_data(init_data: str) -> Optional[dict]:
     
     try:
         # Parse init data
-        parsed = parse_qs(init_data)
+        parsed = _parse_init_data(init_data)
         
         # Get hash
-        received_hash = parsed.get("hash", [None])[0]
+        received_hash = parsed.pop("hash", None)
         if not received_hash:
             return None
         
         # Build data check string
-        data_check_arr = []
-        for key, value in sorted(parsed.items()):
-            if key != "hash":
-                data_check_arr.append(f"{key}={value[0]}")
-        data_check_string = "\n".join(data_check_arr)
-        
-        # Compute secret key
-        secret_key = hmac.new(
-            b"WebAppData",
-            settings.telegram_bot_token.encode(),
-            hashlib.sha256
-        ).digest()
+        data_check_string = "\n".join(
+            f"{key}={value}" for key, value in sorted(parsed.items())
+        )
         
-        # Compute hash
-        computed_hash = hmac.new(
-            secret_key,
+        # Compute hash (hmac.digest is the one-shot OpenSSL fast path)
+        computed_hash = hmac.digest(
+            _TG_SECRET_KEY,
             data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
+            "sha256"
+        ).hex()
         
-        if computed_hash != received_hash:
+        if not hmac.compare_digest(computed_hash, received_hash):
             logger.warning("Invalid Telegram init data hash")
             return None
         
         # Extract user data
-        import json
-        user_data = parsed.get("user", [None])[0]
+        user_data = parsed.get("user")
         if user_data:
-            return json.loads(user_data)
+            return orjson.loads(user_data)
         
         return None
         
@@ -93,25 +111,34 @@ def validate_telegram_init_data(init_data: str) -> Optional[dict]:
         return None
 
 
-async def get_current_user(
-    x_telegram_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data")
-):
+# Validated init data -> user data. The Mini App sends the same init data
+# on every request until reload, so repeat hits skip parsing and HMAC.
+# Only successful validations are cached; invalid data pays the full cost.
+_init_data_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+
+async def authenticate(x_telegram_init_data: Optional[str]):
     """
-    Dependency to get current user from Telegram init data.
+    Resolve the current user from Telegram init data.
+    
+    Raises HTTPException if the init data is missing, invalid or not allowed.
     """
     if not x_telegram_init_data:
         raise HTTPException(status_code=401, detail="Missing Telegram init data")
     
-    user_data = validate_telegram_init_data(x_telegram_init_data)
-    if not user_data:
-        raise HTTPException(status_code=401, detail="Invalid Telegram init data")
+    user_data = _init_data_cache.get(x_telegram_init_data)
+    if user_data is None:
+        user_data = validate_telegram_init_data(x_telegram_init_data)
+        if not user_data:
+            raise HTTPException(status_code=401, detail="Invalid Telegram init data")
+        _init_data_cache[x_telegram_init_data] = user_data
     
     telegram_id = user_data.get("id")
     if not telegram_id:
         raise HTTPException(status_code=401, detail="Missing user ID")
     
     # Check if user is allowed
-    allowed_ids = settings.allowed_user_ids_list
+    allowed_ids = settings.allowed_user_ids_set
     if allowed_ids and telegram_id not in allowed_ids:
         raise HTTPException(status_code=403, detail="Access denied")
     
@@ -126,6 +153,55 @@ async def get_current_user(
     return user
 
 
+# Routes under /api that don't require auth (prefix match)
+PUBLIC_API_PATHS = ("/api/health", "/api/shared/", "/api/telegram/")
+
+
+class TelegramAuthMiddleware:
+    """
+    Pure ASGI middleware authenticating /api requests once per request.
+    
+    Stores the user in request.state so routes read it through a trivial
+    dependency instead of resolving the auth dependency tree each time.
+    """
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        path = scope.get("path", "")
+        if (
+            scope["type"] != "http"
+            or scope["method"] == "OPTIONS"
+            or not path.startswith("/api/")
+            or path.startswith(PUBLIC_API_PATHS)
+        ):
+            await self.app(scope, receive, send)
+            return
+        
+        try:
+            user = await authenticate(Headers(scope=scope).get("x-telegram-init-data"))
+        except HTTPException as e:
+            response = ORJSONResponse({"detail": e.detail}, status_code=e.status_code)
+            await response(scope, receive, send)
+            return
+        
+        scope.setdefault("state", {})["user"] = user
+        await self.app(scope, receive, send)
+
+
+async def get_current_user(request: Request):
+    """
+    Dependency to get current user set by TelegramAuthMiddleware.
+    """
+    return request.state.user
+
+
+# Note IDs stay plain strings: the services only need them as strings for
+# queries, so the pattern check replaces building a UUID object per request
+NoteId = Annotated[str, Path(pattern=r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")]
+
+
 # Response models
 class NotesListResponse(BaseModel):
     notes: List[Note]
@@ -142,12 +218,28 @@ class FTSSearchResponse(BaseModel):
     query: str
 
 
+class HybridSearchResponse(BaseModel):
+    results: List[HybridSearchResult]
+    query: str
+
+
 class SharedNoteResponse(BaseModel):
     note: PublicNote
     is_owner: bool
     can_edit: bool
 
 
+def model_response(model: BaseModel) -> Response:
+    """
+    Serialize an already-validated model straight to a JSON response.
+    
+    Returning a Response bypasses FastAPI's response_model re-validation and
+    jsonable_encoder pass; pydantic-core encodes UUIDs/datetimes natively.
+    The route's response_model is still used for the OpenAPI schema.
+    """
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
 # API Routes
 @router.get("/health")
 async def health_check():
@@ -162,24 +254,21 @@ async def get_notes(
     user=Depends(get_current_user)
 ):
     """Get all notes for the current user."""
-    notes = await notes_service.get_notes(user.id, limit=limit, offset=offset)
-    
-    # Get total count (simplified - could be optimized)
-    all_notes = await notes_service.get_notes(user.id, limit=1000, offset=0)
+    notes, total = await notes_service.get_notes_page(user.id, limit=limit, offset=offset)
     
-    return NotesListResponse(notes=notes, total=len(all_notes))
+    return model_response(NotesListResponse(notes=notes, total=total))
 
 
 @router.get("/notes/{note_id}", response_model=Note)
 async def get_note(
-    note_id: UUID,
+    note_id: NoteId,
     user=Depends(get_current_user)
 ):
     """Get a single note by ID."""
     note = await notes_service.get_note(note_id, user.id)
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
-    return note
+    return model_response(note)
 
 
 @router.post("/notes", response_model=Note)
@@ -190,15 +279,15 @@ async def create_note(
     """Create a new note."""
     note = await notes_service.create_note(user.id, note_data)
     
-    # Index for RAG
-    await rag_service.index_note(str(note.id), note.content)
+    # Index for RAG in the background
+    rag_service.enqueue_index(str(note.id), note.content)
     
     return note
 
 
 @router.put("/notes/{note_id}", response_model=Note)
 async def update_note(
-    note_id: UUID,
+    note_id: NoteId,
     note_data: NoteUpdate,
     user=Depends(get_current_user)
 ):
@@ -209,14 +298,14 @@ async def update_note(
     
     # Re-index if content changed
     if note_data.content:
-        await rag_service.index_note(str(note.id), note.content)
+        rag_service.enqueue_index(str(note.id), note.content)
     
     return note
 
 
 @router.delete("/notes/{note_id}")
 async def delete_note(
-    note_id: UUID,
+    note_id: NoteId,
     user=Depends(get_current_user)
 ):
     """Delete a note."""
@@ -240,16 +329,25 @@ async def search_notes(
             detail=f"AI search not available on {plan} plan. Please upgrade your subscription."
         )
     
-    results = await rag_service.search(
-        query=search.query,
-        user_id=str(user.id),
-        limit=search.limit
-    )
+    if rag_service.rerank_enabled:
+        # Two-stage: over-fetch by vector similarity, then rerank
+        candidates = await rag_service.search(
+            query=search.query,
+            user_id=str(user.id),
+            limit=search.limit * 4
+        )
+        results = (await rag_service.rerank(search.query, candidates))[:search.limit]
+    else:
+        results = await rag_service.search(
+            query=search.query,
+            user_id=str(user.id),
+            limit=search.limit
+        )
     
-    # Track usage
-    await notes_service.increment_usage(user.id, "chat_messages", 1)
+    # Track usage (written in a batch off the request path)
+    usage_buffer.add(user.id, "chat_messages", 1)
     
-    return SearchResponse(results=results, query=search.query)
+    return model_response(SearchResponse(results=results, query=search.query))
 
 
 @router.get("/stats", response_model=StatsResponse)
@@ -273,10 +371,86 @@ async def search_notes_fts(
     return FTSSearchResponse(results=results, query=search.query)
 
 
+# Reciprocal Rank Fusion constant (standard value from the RRF paper)
+RRF_K = 60
+
+
+def fuse_search_results(
+    fts_results: List[FTSSearchResult],
+    semantic_results: List[SearchResult],
+    limit: int
+) -> List[HybridSearchResult]:
+    """Merge FTS and semantic rankings with Reciprocal Rank Fusion."""
+    fused: dict = {}
+    
+    for position, r in enumerate(fts_results, 1):
+        fused[r.id] = HybridSearchResult(
+            id=r.id,
+            content=r.content,
+            summary=r.summary,
+            created_at=r.created_at,
+            score=1 / (RRF_K + position),
+            rank=r.rank
+        )
+    
+    for position, r in enumerate(semantic_results, 1):
+        item = fused.get(r.id)
+        if item:
+            item.score += 1 / (RRF_K + position)
+            item.similarity = r.similarity
+        else:
+            fused[r.id] = HybridSearchResult(
+                id=r.id,
+                content=r.content,
+                summary=r.summary,
+                created_at=r.created_at,
+                score=1 / (RRF_K + position),
+                similarity=r.similarity
+            )
+    
+    return sorted(fused.values(), key=lambda r: r.score, reverse=True)[:limit]
+
+
+@router.post("/notes/search/hybrid", response_model=HybridSearchResponse)
+async def search_notes_hybrid(
+    search: SearchQuery,
+    user=Depends(get_current_user)
+):
+    """
+    Hybrid search: FTS and semantic search run concurrently, fused with RRF.
+    
+    Falls back to FTS only if the plan has no AI search.
+    """
+    can_use, _, _ = await notes_service.can_use_feature(user.id, "chat")
+    
+    fts_task = notes_service.search_notes_fts(
+        user_id=user.id,
+        query=search.query,
+        limit=search.limit
+    )
+    
+    if can_use:
+        fts_results, semantic_results = await asyncio.gather(
+            fts_task,
+            rag_service.search(
+                query=search.query,
+                user_id=str(user.id),
+                limit=search.limit
+            )
+        )
+        usage_buffer.add(user.id, "chat_messages", 1)
+    else:
+        fts_results = await fts_task
+        semantic_results = []
+    
+    results = fuse_search_results(fts_results, semantic_results, search.limit)
+    return model_response(HybridSearchResponse(results=results, query=search.query))
+
+
 # Share functionality
 @router.post("/notes/{note_id}/share", response_model=ShareResponse)
 async def create_share_link(
-    note_id: UUID,
+    note_id: NoteId,
     is_public: bool = Query(default=False, description="Make note publicly viewable"),
     user=Depends(get_current_user)
 ):
@@ -301,7 +475,7 @@ async def create_share_link(
 
 @router.delete("/notes/{note_id}/share")
 async def revoke_share_link(
-    note_id: UUID,
+    note_id: NoteId,
     user=Depends(get_current_user)
 ):
     """Revoke share link for a note."""
@@ -368,11 +542,11 @@ async def get_shared_note(
         created_at=note.created_at
     )
     
-    return SharedNoteResponse(
+    return model_response(SharedNoteResponse(
         note=public_note,
         is_owner=is_owner,
         can_edit=can_edit
-    )
+    ))
 
 
 # Subscription endpoints
@@ -383,38 +557,42 @@ async def get_subscription(user=Depends(get_current_user)):
     return subscription_info
 
 
+# Pricing in Telegram Stars
+SUBSCRIPTION_PRICING = {
+    "pro": {"monthly": 350, "yearly": 3500},
+    "ultra": {"monthly": 800, "yearly": 8000},
+}
+
+# (plan, period) -> (invoice title, invoice description)
+INVOICE_TEXTS = {
+    (plan, period): (
+        f"FixNote {plan.title()} - {period.title()}",
+        f"Subscription to FixNote {plan.title()} plan ({period})"
+    )
+    for plan, periods in SUBSCRIPTION_PRICING.items()
+    for period in periods
+}
+
+
 @router.post("/subscription/invoice", response_model=InvoiceResponse)
 async def create_subscription_invoice(
     request: InvoiceRequest,
     user=Depends(get_current_user)
 ):
     """Create a Telegram Stars invoice for subscription."""
-    from .config import settings
-    
-    # Pricing in Telegram Stars
-    pricing = {
-        "pro": {"monthly": 350, "yearly": 3500},
-        "ultra": {"monthly": 800, "yearly": 8000},
-    }
-    
     plan = request.plan
     period = request.billing_period
-    amount = pricing[plan][period]
+    amount = SUBSCRIPTION_PRICING[plan][period]
     
     # Create invoice link through bot
     if _bot_instance is None:
         raise HTTPException(status_code=503, detail="Bot not available")
     
     try:
-        from aiogram.types import LabeledPrice
-        import uuid
-        
-        # Create invoice payload
-        title = f"FixNote {plan.title()} - {period.title()}"
-        description = f"Subscription to FixNote {plan.title()} plan ({period})"
+        title, description = INVOICE_TEXTS[plan, period]
         
         # Generate unique payload for this purchase
-        payload = f"{user.id}:{plan}:{period}:{uuid.uuid4().hex[:8]}"
+        payload = f"{user.id}:{plan}:{period}:{secrets.token_hex(4)}"
         
         # Create invoice link using Telegram Stars (XTR)
         # For Stars payments, provider_token must be empty string
@@ -1,6 +1,14 @@
 import logging
 import asyncio
-from collections import defaultdict
+import hmac
+import io
+import re
+import secrets
+import tempfile
+from typing import List, Optional
+
+import orjson
+from cachetools import TTLCache
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import (
@@ -12,75 +20,119 @@ from aiogram.types import (
     InlineQueryResultArticle,
     InputTextMessageContent,
     PreCheckoutQuery,
-    LabeledPrice
+    Update
 )
-from aiogram.filters import Command, CommandStart
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.enums import ParseMode
-from aiogram.methods import CreateInvoiceLink
+from aiogram.methods import GetUpdates
 
 from .config import settings
-from .db.models import NoteCreate
+from .rate_limit import TokenBucket
+from .db.models import NoteCreate, NoteUpdate, SearchResult
 from .services.notes_service import NotesService
 from .services.transcription import TranscriptionService
-from .services.summarizer import SummarizerService
+from .services.summarizer import CONTEXT_MIN_SIMILARITY, MIN_SUMMARY_TEXT_LENGTH, SummarizerService
 from .services.rag_service import RAGService
 
 logger = logging.getLogger(__name__)
 
+def _orjson_dumps(value) -> str:
+    """orjson.dumps returning str, as aiogram expects from json_dumps."""
+    return orjson.dumps(value).decode()
+
+
 # Initialize bot and dispatcher
-bot = Bot(token=settings.telegram_bot_token)
+# One pooled aiohttp session serves every outbound Telegram call, both from
+# handlers and from the API (set_bot_instance), so TLS connections are reused
+# (aiohttp's connector pools up to 100 connections by default).
+# Payloads (incl. getUpdates batches) are (de)serialized with orjson.
+bot = Bot(
+    token=settings.telegram_bot_token,
+    session=AiohttpSession(json_loads=orjson.loads, json_dumps=_orjson_dumps)
+)
 dp = Dispatcher()
 router = Router()
 
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Paces all outbound Bot API calls through one token bucket.
+    
+    Keeps bursts under Telegram's global ~30 req/s limit instead of hitting
+    429s, and retries once after the server-provided delay if one slips through.
+    """
+    
+    def __init__(self, rate: float = 30):
+        self.bucket = TokenBucket(rate)
+    
+    async def __call__(self, make_request, bot, method):
+        # Long polling is not a message send, don't let it wait behind them
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        
+        await self.bucket.acquire()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram rate limit hit, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            return await make_request(bot, method)
+
+
+bot.session.middleware(RateLimitMiddleware())
+
 # Services
 notes_service = NotesService()
 transcription_service = TranscriptionService()
 summarizer_service = SummarizerService()
 rag_service = RAGService()
 
-# Buffer for collecting forwarded messages (user_id -> list of messages)
-forwarded_messages_buffer: dict[int, list[Message]] = defaultdict(list)
-forwarded_messages_tasks: dict[int, asyncio.Task] = {}
+# Buffer for collecting forwarded messages
+# (user_id -> (username, first_name, [texts])). Only the fields needed to
+# save the note are kept, not whole Message objects. Bounded, and entries
+# of abandoned batches expire.
+forwarded_messages_buffer: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+# Debounce deadline per user (event loop time); one flush task per batch
+forwarded_deadlines: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+FORWARD_DEBOUNCE_SECONDS = 0.5
 
+# Strong references to fire-and-forget tasks so they aren't GC'd mid-flight
+background_tasks: set[asyncio.Task] = set()
 
-def get_notes_inline_keyboard() -> InlineKeyboardMarkup:
-    """Get inline keyboard with Mini App button."""
-    if settings.public_url:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text="📋 Открыть заметки",
-                web_app=WebAppInfo(url=f"{settings.public_url}/app")
-            )]
-        ])
-    else:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-    return keyboard
 
+def spawn(coro) -> asyncio.Task:
+    """Run a coroutine in the background, keeping a reference until done."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
-def check_user_allowed(user_id: int) -> bool:
-    """Check if user is allowed to use the bot."""
-    allowed_ids = settings.allowed_user_ids_list
-    if not allowed_ids:
-        return True
-    return user_id in allowed_ids
 
+# Question words that mark a text message as a RAG query (matched at start,
+# case-insensitively, without lowercasing the whole message)
+QUESTION_START_RE = re.compile(
+    r"(?:что|как|где|когда|почему|кто|какой|сколько)\s",
+    re.IGNORECASE
+)
 
-# Command handlers
-@router.message(CommandStart())
-async def cmd_start(message: Message):
-    """Handle /start command."""
-    if not check_user_allowed(message.from_user.id):
-        await message.answer("⛔ Доступ запрещён.")
-        return
-    
-    user = await notes_service.get_or_create_user(
-        telegram_id=message.from_user.id,
-        username=message.from_user.username,
-        first_name=message.from_user.first_name,
-        language_code=message.from_user.language_code or "ru"
-    )
-    
-    welcome_text = f"""👋 Привет, {message.from_user.first_name or 'друг'}!
+# Inline share queries look like "share_note_<token>"
+SHARE_QUERY_PREFIX = "share_note_"
+SHARE_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{16,64}")
+
+NOTE_DATE_FORMAT = "%d.%m %H:%M"
+
+# Voice downloads up to this size are buffered in memory, larger ones on disk
+VOICE_MEMORY_MAX_SIZE = 1 << 20
+
+# Minimum pause between progressive edits of a streamed answer (Telegram
+# throttles message edits, so tokens are flushed in batches)
+ANSWER_EDIT_INTERVAL = 1.5
+
+# Static texts (Markdown), built once at import
+WELCOME_TEXT_TEMPLATE = """👋 Привет, {name}!
 
 Я бот для голосовых и текстовых заметок с AI-возможностями:
 
@@ -93,17 +145,8 @@ async def cmd_start(message: Message):
 📋 **Mini App** — открой все заметки в удобном интерфейсе
 
 Начни с отправки голосового или текстового сообщения!"""
-    
-    await message.answer(
-        welcome_text, 
-        parse_mode=ParseMode.MARKDOWN
-    )
 
-
-@router.message(Command("help"))
-async def cmd_help(message: Message):
-    """Handle /help command."""
-    help_text = """📖 **Справка по боту**
+HELP_TEXT = """📖 **Справка по боту**
 
 **Команды:**
 /start — Начать работу
@@ -128,13 +171,186 @@ async def cmd_help(message: Message):
 
 _Пример: /ask Что мы обсуждали на прошлой встрече?_"""
 
-    await message.answer(help_text, parse_mode=ParseMode.MARKDOWN)
+CHAT_FREE_PLAN_TEXT = (
+    "🔒 **AI-чат недоступен**\n\n"
+    "На бесплатном плане AI-поиск по заметкам не поддерживается.\n\n"
+    "Оформите подписку Pro или Ultra, чтобы задавать вопросы по своим заметкам."
+)
+
+CHAT_NOT_AVAILABLE_TEMPLATE = (
+    "🔒 **AI-чат недоступен**\n\n"
+    "На плане {plan} AI-чат не поддерживается.\n\n"
+    "Обновите подписку для доступа к этой функции."
+)
+
+VOICE_FREE_PLAN_TEXT = (
+    "🔒 **Голосовые заметки недоступны**\n\n"
+    "На бесплатном плане голосовые заметки не поддерживаются.\n\n"
+    "Оформите подписку Pro или Ultra, чтобы:\n"
+    "• Записывать голосовые заметки\n"
+    "• Получать AI-саммари\n"
+    "• Использовать AI-чат\n\n"
+    "Откройте приложение для оформления подписки 👇"
+)
+
+VOICE_LIMIT_REACHED_TEMPLATE = (
+    "⚠️ **Лимит голосовых заметок исчерпан**\n\n"
+    "Вы достигли лимита голосовых заметок на плане {plan}.\n\n"
+    "Обновите подписку до Ultra для увеличения лимита или дождитесь следующего месяца."
+)
+
+
+def _build_notes_inline_keyboard() -> InlineKeyboardMarkup:
+    """Build inline keyboard with Mini App button."""
+    if settings.public_url:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(
+                text="📋 Открыть заметки",
+                web_app=WebAppInfo(url=f"{settings.public_url}/app")
+            )]
+        ])
+    else:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    return keyboard
+
+
+# public_url is fixed for the process lifetime, so one keyboard serves all
+NOTES_KEYBOARD = _build_notes_inline_keyboard()
+
+
+def get_notes_inline_keyboard() -> InlineKeyboardMarkup:
+    """Get inline keyboard with Mini App button."""
+    return NOTES_KEYBOARD
+
+
+def truncate(text: str, limit: int) -> str:
+    """Cut text to limit characters, marking the cut with an ellipsis."""
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+def check_user_allowed(user_id: int) -> bool:
+    """Check if user is allowed to use the bot."""
+    allowed_ids = settings.allowed_user_ids_set
+    return not allowed_ids or user_id in allowed_ids
+
+
+# Feature access by (user_id, feature); subscription state rarely changes
+FEATURES = ("voice", "summary", "chat")
+_feature_cache: TTLCache = TTLCache(maxsize=8192, ttl=60)
+
+
+async def can_use_feature_cached(user_id, feature: str) -> tuple[bool, str, str]:
+    """can_use_feature with a short per-user cache."""
+    key = (str(user_id), feature)
+    result = _feature_cache.get(key)
+    if result is None:
+        result = await notes_service.can_use_feature(user_id, feature)
+        # Don't cache the fail-open answer given when the check itself failed
+        if result[2] != "error":
+            _feature_cache[key] = result
+    return result
+
+
+# RAG search results by (user_id, normalized question); repeated questions
+# within a minute skip the embedding call and vector search
+_rag_search_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+
+async def search_notes_cached(user_id, question: str) -> List[SearchResult]:
+    """Search the user's notes for RAG context, cached briefly per question."""
+    key = (str(user_id), " ".join(question.lower().split()))
+    results = _rag_search_cache.get(key)
+    if results is None:
+        results = await rag_service.search_with_threshold(
+            query=question,
+            user_id=str(user_id),
+            limit=5,
+            # Same cutoff the answer context uses, so any result found here
+            # is actually sent to the LLM
+            min_similarity=CONTEXT_MIN_SIMILARITY
+        )
+        # search() returns [] on embedding/RPC errors too, so empty results
+        # aren't cached: a transient failure must not stick for the TTL
+        if results:
+            _rag_search_cache[key] = results
+    return results
+
+
+async def stream_answer(status_msg: Message, question: str, results: List[SearchResult]) -> None:
+    """Stream the RAG answer into status_msg, then render the final Markdown."""
+    loop = asyncio.get_running_loop()
+    answer = ""
+    shown = ""
+    last_edit = loop.time()
+    
+    # The search just embedded the question, so this is a local lookup
+    query_embedding = rag_service.get_cached_query_embedding(question)
+    async for delta in summarizer_service.ask_stream(question, results, query_embedding):
+        answer += delta
+        if loop.time() - last_edit < ANSWER_EDIT_INTERVAL:
+            continue
+        partial = answer.strip()
+        if partial and partial != shown:
+            # Partial text may have unbalanced Markdown, so send it plain
+            try:
+                await status_msg.edit_text(f"💡 Ответ:\n\n{partial}…")
+                shown = partial
+            except TelegramBadRequest:
+                pass
+            last_edit = loop.time()
+    
+    await status_msg.edit_text(f"💡 **Ответ:**\n\n{answer.strip()}", parse_mode=ParseMode.MARKDOWN)
+
+
+# Last /status health check results; repeated /status calls within the TTL
+# don't probe the external services again
+_status_cache: TTLCache = TTLCache(maxsize=1, ttl=30)
+
+
+def invalidate_user_caches(telegram_id: int, user_id) -> None:
+    """Forget cached user and feature access after a subscription change."""
+    notes_service.invalidate_user(telegram_id)
+    for feature in FEATURES:
+        _feature_cache.pop((str(user_id), feature), None)
+
+
+# Command handlers
+@router.message(CommandStart())
+async def cmd_start(message: Message):
+    """Handle /start command."""
+    from_user = message.from_user
+    
+    if not check_user_allowed(from_user.id):
+        await message.answer("⛔ Доступ запрещён.")
+        return
+    
+    user = await notes_service.get_or_create_user(
+        telegram_id=from_user.id,
+        username=from_user.username,
+        first_name=from_user.first_name,
+        language_code=from_user.language_code or "ru"
+    )
+    
+    welcome_text = WELCOME_TEXT_TEMPLATE.format(name=from_user.first_name or "друг")
+    
+    await message.answer(
+        welcome_text, 
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+
+@router.message(Command("help"))
+async def cmd_help(message: Message):
+    """Handle /help command."""
+    await message.answer(HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
 
 
 @router.message(Command("notes"))
 async def cmd_notes(message: Message):
     """Handle /notes command - open Mini App."""
-    if not check_user_allowed(message.from_user.id):
+    from_user = message.from_user
+    
+    if not check_user_allowed(from_user.id):
         return
     
     if settings.public_url:
@@ -145,9 +361,9 @@ async def cmd_notes(message: Message):
     else:
         # Fallback: show recent notes
         user = await notes_service.get_or_create_user(
-            telegram_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name
+            telegram_id=from_user.id,
+            username=from_user.username,
+            first_name=from_user.first_name
         )
         
         notes = await notes_service.get_notes(user.id, limit=10)
@@ -156,28 +372,31 @@ async def cmd_notes(message: Message):
             await message.answer("📝 У тебя пока нет заметок. Отправь голосовое или текстовое сообщение!")
             return
         
-        text_parts = ["📋 **Последние заметки:**\n"]
-        for i, note in enumerate(notes, 1):
-            icon = "🎤" if note.source == "voice" else "📝"
-            preview = (note.summary or note.content)[:100]
-            if len(note.summary or note.content) > 100:
-                preview += "..."
-            date = note.created_at.strftime("%d.%m %H:%M")
-            text_parts.append(f"{i}. {icon} {preview}\n   _{date}_\n")
+        notes_text = "\n".join(
+            f"{i}. {'🎤' if note.source == 'voice' else '📝'} "
+            f"{truncate(note.summary or note.content, 100)}\n"
+            f"   _{note.created_at:{NOTE_DATE_FORMAT}}_\n"
+            for i, note in enumerate(notes, 1)
+        )
         
-        await message.answer("\n".join(text_parts), parse_mode=ParseMode.MARKDOWN)
+        await message.answer(
+            f"📋 **Последние заметки:**\n\n{notes_text}",
+            parse_mode=ParseMode.MARKDOWN
+        )
 
 
 @router.message(Command("stats"))
 async def cmd_stats(message: Message):
     """Handle /stats command."""
-    if not check_user_allowed(message.from_user.id):
+    from_user = message.from_user
+    
+    if not check_user_allowed(from_user.id):
         return
     
     user = await notes_service.get_or_create_user(
-        telegram_id=message.from_user.id,
-        username=message.from_user.username,
-        first_name=message.from_user.first_name
+        telegram_id=from_user.id,
+        username=from_user.username,
+        first_name=from_user.first_name
     )
     
     stats = await notes_service.get_stats(user.id)
@@ -195,13 +414,15 @@ async def cmd_stats(message: Message):
 
 
 @router.message(Command("ask"))
-async def cmd_ask(message: Message):
+async def cmd_ask(message: Message, command: CommandObject):
     """Handle /ask command - RAG query."""
-    if not check_user_allowed(message.from_user.id):
+    from_user = message.from_user
+    
+    if not check_user_allowed(from_user.id):
         return
     
     # Extract question from command
-    question = message.text.replace("/ask", "").strip()
+    question = (command.args or "").strip()
     
     if not question:
         await message.answer(
@@ -211,28 +432,24 @@ async def cmd_ask(message: Message):
         return
     
     user = await notes_service.get_or_create_user(
-        telegram_id=message.from_user.id,
-        username=message.from_user.username,
-        first_name=message.from_user.first_name
+        telegram_id=from_user.id,
+        username=from_user.username,
+        first_name=from_user.first_name
     )
     
     # Check subscription for AI chat feature
-    can_use, plan, reason = await notes_service.can_use_feature(user.id, "chat")
+    can_use, plan, reason = await can_use_feature_cached(user.id, "chat")
     if not can_use:
         if reason == "free_plan":
             await message.answer(
-                "🔒 **AI-чат недоступен**\n\n"
-                "На бесплатном плане AI-поиск по заметкам не поддерживается.\n\n"
-                "Оформите подписку Pro или Ultra, чтобы задавать вопросы по своим заметкам.",
+                CHAT_FREE_PLAN_TEXT,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_notes_inline_keyboard()
             )
             return
         elif reason == "not_available":
             await message.answer(
-                "🔒 **AI-чат недоступен**\n\n"
-                f"На плане {plan.title()} AI-чат не поддерживается.\n\n"
-                "Обновите подписку для доступа к этой функции.",
+                CHAT_NOT_AVAILABLE_TEMPLATE.format(plan=plan.title()),
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_notes_inline_keyboard()
             )
@@ -242,12 +459,7 @@ async def cmd_ask(message: Message):
     status_msg = await message.answer("🔍 Ищу в твоих заметках...")
     
     # Search for relevant notes
-    results = await rag_service.search_with_threshold(
-        query=question,
-        user_id=str(user.id),
-        limit=5,
-        min_similarity=0.2
-    )
+    results = await search_notes_cached(user.id, question)
     
     if not results:
         await status_msg.edit_text(
@@ -255,23 +467,11 @@ async def cmd_ask(message: Message):
         )
         return
     
-    # Convert results to dict for summarizer
-    context = [
-        {
-            "content": r.content,
-            "summary": r.summary,
-            "similarity": r.similarity
-        }
-        for r in results
-    ]
-    
     # Generate AI response
-    answer = await summarizer_service.ask(question, context)
+    await stream_answer(status_msg, question, results)
     
     # Track chat usage
     await notes_service.increment_usage(user.id, "chat_messages", 1)
-    
-    await status_msg.edit_text(f"💡 **Ответ:**\n\n{answer}", parse_mode=ParseMode.MARKDOWN)
 
 
 @router.message(Command("status"))
@@ -282,9 +482,15 @@ async def cmd_status(message: Message):
     
     status_msg = await message.answer("🔄 Проверяю сервисы...")
     
-    whisper_ok = await transcription_service.health_check()
-    deepseek_ok = await summarizer_service.health_check()
-    openai_ok = await rag_service.health_check()
+    statuses = _status_cache.get("services")
+    if statuses is None:
+        statuses = await asyncio.gather(
+            transcription_service.health_check(),
+            summarizer_service.health_check(),
+            rag_service.health_check()
+        )
+        _status_cache["services"] = statuses
+    whisper_ok, deepseek_ok, openai_ok = statuses
     
     status_text = f"""📡 **Статус сервисов:**
 
@@ -301,12 +507,14 @@ async def handle_inline_query(inline_query: InlineQuery):
     """Handle inline queries for sharing notes."""
     query = inline_query.query
     
-    # Only handle share_note_ queries
-    if not query.startswith("share_note_"):
+    # Only handle share_note_ queries; answer anything else with an empty
+    # result Telegram can cache instead of asking again
+    if not query.startswith(SHARE_QUERY_PREFIX):
+        await inline_query.answer([], cache_time=300, is_personal=False)
         return
     
-    share_token = query.replace("share_note_", "")
-    if not share_token or len(share_token) < 16:
+    share_token = query[len(SHARE_QUERY_PREFIX):]
+    if not SHARE_TOKEN_RE.fullmatch(share_token):
         return
     
     # Get shared note data
@@ -317,9 +525,8 @@ async def handle_inline_query(inline_query: InlineQuery):
     note = result["note"]
     
     # Get first line of content as preview
-    first_line = note.content.split('\n')[0].strip()
-    if len(first_line) > 60:
-        first_line = first_line[:60] + "..."
+    first_line = note.content.partition('\n')[0].strip()
+    first_line = truncate(first_line, 60)
     
     # Prepare title for inline picker
     title = f"📝 {first_line}"
@@ -357,36 +564,30 @@ async def handle_inline_query(inline_query: InlineQuery):
 @router.message(F.voice)
 async def handle_voice(message: Message):
     """Handle voice message - transcribe and save as note."""
-    if not check_user_allowed(message.from_user.id):
+    from_user = message.from_user
+    
+    if not check_user_allowed(from_user.id):
         return
     
     user = await notes_service.get_or_create_user(
-        telegram_id=message.from_user.id,
-        username=message.from_user.username,
-        first_name=message.from_user.first_name
+        telegram_id=from_user.id,
+        username=from_user.username,
+        first_name=from_user.first_name
     )
     
     # Check subscription for voice feature
-    can_use, plan, reason = await notes_service.can_use_feature(user.id, "voice")
+    can_use, plan, reason = await can_use_feature_cached(user.id, "voice")
     if not can_use:
         if reason == "free_plan":
             await message.answer(
-                "🔒 **Голосовые заметки недоступны**\n\n"
-                "На бесплатном плане голосовые заметки не поддерживаются.\n\n"
-                "Оформите подписку Pro или Ultra, чтобы:\n"
-                "• Записывать голосовые заметки\n"
-                "• Получать AI-саммари\n"
-                "• Использовать AI-чат\n\n"
-                "Откройте приложение для оформления подписки 👇",
+                VOICE_FREE_PLAN_TEXT,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_notes_inline_keyboard()
             )
             return
         elif reason == "limit_reached":
             await message.answer(
-                "⚠️ **Лимит голосовых заметок исчерпан**\n\n"
-                f"Вы достигли лимита голосовых заметок на плане {plan.title()}.\n\n"
-                "Обновите подписку до Ultra для увеличения лимита или дождитесь следующего месяца.",
+                VOICE_LIMIT_REACHED_TEMPLATE.format(plan=plan.title()),
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=get_notes_inline_keyboard()
             )
@@ -395,68 +596,66 @@ async def handle_voice(message: Message):
     # Send initial status message (will be edited)
     status_msg = await message.answer("🎧 Обрабатываю голосовое сообщение...")
     
+    # Summary access check runs while the audio is downloaded and transcribed
+    summary_check = asyncio.ensure_future(can_use_feature_cached(user.id, "summary"))
+    
     try:
-        # Download voice file
+        # Download voice file in chunks and stream it to Whisper. Short notes
+        # go to a BytesIO: a SpooledTemporaryFile would be rolled over to disk
+        # anyway, since httpx calls fileno() to size the multipart upload.
+        # Unknown or large sizes go straight to a temp file.
         file = await bot.get_file(message.voice.file_id)
-        file_data = await bot.download_file(file.file_path)
-        
-        # Transcribe
-        transcription = await transcription_service.transcribe_bytes(
-            audio_data=file_data.read(),
-            filename=f"voice_{message.voice.file_id}.ogg",
-            language="ru"
-        )
+        file_size = message.voice.file_size or file.file_size
+        in_memory = file_size is not None and file_size <= VOICE_MEMORY_MAX_SIZE
+        with io.BytesIO() if in_memory else tempfile.TemporaryFile() as audio_file:
+            await bot.download_file(file.file_path, destination=audio_file)
+            
+            # Transcribe
+            transcription = await transcription_service.transcribe_file(
+                audio_file,
+                filename=f"voice_{message.voice.file_id}.ogg",
+                language="ru"
+            )
         
         if not transcription:
             await status_msg.edit_text("❌ Не удалось транскрибировать аудио. Попробуй ещё раз.")
             return
         
-        # Track voice usage (in seconds)
-        await notes_service.increment_usage(user.id, "voice_seconds", message.voice.duration or 0)
+        # Track voice usage (in seconds), off the critical path
+        spawn(notes_service.increment_usage(user.id, "voice_seconds", message.voice.duration or 0))
         
         # Check subscription for summary feature
-        can_summarize, _, _ = await notes_service.can_use_feature(user.id, "summary")
-        
-        summary = None
-        if can_summarize:
-            # Update status
-            await status_msg.edit_text("✨ Создаю саммари...")
-            
-            # Generate summary
-            summary = await summarizer_service.summarize(transcription)
-            
-            # Track summary usage
-            if summary:
-                await notes_service.increment_usage(user.id, "summaries", 1)
+        can_summarize, _, _ = await summary_check
         
-        # Save note
+        # Save the transcript right away; the summary is added when ready
         note = await notes_service.create_note(
             user_id=user.id,
             note_data=NoteCreate(
                 content=transcription,
-                summary=summary,
                 source="voice",
                 duration_seconds=message.voice.duration
             )
         )
         
-        # Index for RAG
-        await rag_service.index_note(str(note.id), transcription)
+        # Index for RAG in the background
+        rag_service.enqueue_index(str(note.id), transcription)
         
-        # Final response - edit the same message
+        # Show the transcript now - edit the same message
         response = f"""✅ **Заметка сохранена!**
 
 📝 **Текст:**
-{transcription[:500]}{"..." if len(transcription) > 500 else ""}
+{truncate(transcription, 500)}
 
 """
-        if summary:
-            response += f"""💡 **Саммари:**
-{summary}"""
-        elif not can_summarize:
+        if not can_summarize:
             response += "_💡 AI-саммари недоступно на вашем плане_"
-        
-        await status_msg.edit_text(response, parse_mode=ParseMode.MARKDOWN)
+            await status_msg.edit_text(response, parse_mode=ParseMode.MARKDOWN)
+        elif len(transcription.strip()) < MIN_SUMMARY_TEXT_LENGTH:
+            # Short enough to read as is; summarize() would skip it anyway
+            await status_msg.edit_text(response, parse_mode=ParseMode.MARKDOWN)
+        else:
+            await status_msg.edit_text(response + "_💡 Готовлю саммари..._", parse_mode=ParseMode.MARKDOWN)
+            spawn(add_voice_summary(status_msg, response, user.id, note.id, transcription))
         
     except Exception as e:
         logger.error(f"Voice processing error: {e}")
@@ -466,34 +665,44 @@ async def handle_voice(message: Message):
             await message.answer("❌ Произошла ошибка при обработке. Попробуй позже.")
 
 
+async def add_voice_summary(status_msg: Message, response: str, user_id, note_id, transcription: str):
+    """Summarize a saved voice note, store the summary and show it in the reply."""
+    try:
+        summary = await summarizer_service.summarize(transcription)
+        if summary:
+            await notes_service.update_note(note_id, user_id, NoteUpdate(summary=summary))
+            spawn(notes_service.increment_usage(user_id, "summaries", 1))
+            response += f"""💡 **Саммари:**
+{summary}"""
+        await status_msg.edit_text(response, parse_mode=ParseMode.MARKDOWN)
+    except Exception as e:
+        logger.error(f"Voice summary error for note {note_id}: {e}")
+
+
 async def process_forwarded_messages(user_id: int, chat_id: int):
-    """Process buffered forwarded messages after delay."""
-    await asyncio.sleep(0.5)  # Wait for more messages to arrive
+    """Process buffered forwarded messages once no more arrive for a while."""
+    loop = asyncio.get_running_loop()
     
-    messages = forwarded_messages_buffer.pop(user_id, [])
-    forwarded_messages_tasks.pop(user_id, None)
+    # Each new message pushes the deadline; sleep until it stops moving
+    while (delay := forwarded_deadlines.get(user_id, 0) - loop.time()) > 0:
+        await asyncio.sleep(delay)
     
-    if not messages:
+    batch = forwarded_messages_buffer.pop(user_id, None)
+    forwarded_deadlines.pop(user_id, None)
+    
+    if not batch:
         return
     
     # Get user
-    first_msg = messages[0]
+    username, first_name, texts = batch
     user = await notes_service.get_or_create_user(
         telegram_id=user_id,
-        username=first_msg.from_user.username,
-        first_name=first_msg.from_user.first_name
+        username=username,
+        first_name=first_name
     )
     
     # Combine all message texts
-    combined_texts = []
-    for msg in messages:
-        if msg.text:
-            combined_texts.append(msg.text.strip())
-    
-    if not combined_texts:
-        return
-    
-    combined_text = "\n\n".join(combined_texts)
+    combined_text = "\n\n".join(texts)
     
     # Save as single note
     note = await notes_service.create_note(
@@ -504,11 +713,11 @@ async def process_forwarded_messages(user_id: int, chat_id: int):
         )
     )
     
-    # Index for RAG
-    await rag_service.index_note(str(note.id), combined_text)
+    # Index for RAG in the background
+    rag_service.enqueue_index(str(note.id), combined_text)
     
     # Send confirmation
-    msg_count = len(messages)
+    msg_count = len(texts)
     await bot.send_message(
         chat_id,
         f"✅ {msg_count} сообщений сохранено как 1 заметка!"
@@ -518,48 +727,49 @@ async def process_forwarded_messages(user_id: int, chat_id: int):
 @router.message(F.text)
 async def handle_text(message: Message):
     """Handle text message - save as note or process as AI query."""
-    if not check_user_allowed(message.from_user.id):
+    from_user = message.from_user
+    
+    if not check_user_allowed(from_user.id):
         return
     
     # Skip commands
     if message.text.startswith("/"):
         return
     
-    user_id = message.from_user.id
+    user_id = from_user.id
     
     # Check if this is a forwarded message
     if message.forward_date:
         # Add to buffer
-        forwarded_messages_buffer[user_id].append(message)
+        batch = forwarded_messages_buffer.get(user_id)
+        if batch is None:
+            batch = (from_user.username, from_user.first_name, [])
+            forwarded_messages_buffer[user_id] = batch
+        batch[2].append(message.text.strip())
         
-        # Cancel existing task if any
-        if user_id in forwarded_messages_tasks:
-            forwarded_messages_tasks[user_id].cancel()
-        
-        # Schedule processing after delay
-        task = asyncio.create_task(
-            process_forwarded_messages(user_id, message.chat.id)
-        )
-        forwarded_messages_tasks[user_id] = task
+        # Push the deadline; only the first message of a batch starts a task
+        is_first = user_id not in forwarded_deadlines
+        forwarded_deadlines[user_id] = asyncio.get_running_loop().time() + FORWARD_DEBOUNCE_SECONDS
+        if is_first:
+            spawn(process_forwarded_messages(user_id, message.chat.id))
         return
     
     user = await notes_service.get_or_create_user(
-        telegram_id=message.from_user.id,
-        username=message.from_user.username,
-        first_name=message.from_user.first_name
+        telegram_id=from_user.id,
+        username=from_user.username,
+        first_name=from_user.first_name
     )
     
     text = message.text.strip()
     
-    # Check if it's a question (for RAG)
-    is_question = (
-        text.endswith("?") or 
-        text.lower().startswith(("что ", "как ", "где ", "когда ", "почему ", "кто ", "какой ", "сколько "))
+    # Check if it's a short question (for RAG); long texts are always notes
+    is_question = len(text) < 200 and (
+        text.endswith("?") or QUESTION_START_RE.match(text) is not None
     )
     
-    if is_question and len(text) < 200:
+    if is_question:
         # Check subscription for AI chat feature
-        can_use, _, _ = await notes_service.can_use_feature(user.id, "chat")
+        can_use, _, _ = await can_use_feature_cached(user.id, "chat")
         
         if not can_use:
             # Can't use AI - just save as note
@@ -569,49 +779,40 @@ async def handle_text(message: Message):
         # Treat as AI query - edit single message
         status_msg = await message.answer("🔍 Ищу ответ в заметках...")
         
-        results = await rag_service.search_with_threshold(
-            query=text,
-            user_id=str(user.id),
-            limit=5,
-            min_similarity=0.2
-        )
+        results = await search_notes_cached(user.id, text)
         
         if results:
-            context = [
-                {
-                    "content": r.content,
-                    "summary": r.summary,
-                    "similarity": r.similarity
-                }
-                for r in results
-            ]
-            answer = await summarizer_service.ask(text, context)
+            await stream_answer(status_msg, text, results)
             
             # Track chat usage
             await notes_service.increment_usage(user.id, "chat_messages", 1)
-            
-            await status_msg.edit_text(f"💡 **Ответ:**\n\n{answer}", parse_mode=ParseMode.MARKDOWN)
         else:
-            # No results - save as note instead
+            # No results - save as note instead, reusing the search embedding
             await status_msg.delete()
-            await save_text_note(message, user, text)
+            await save_text_note(
+                message, user, text,
+                embedding=rag_service.get_cached_query_embedding(text, exact=True)
+            )
     else:
         # Save as note
         await save_text_note(message, user, text)
 
 
-async def save_text_note(message: Message, user, text: str):
-    """Save text as a note."""
+async def save_text_note(message: Message, user, text: str,
+                         embedding: Optional[List[float]] = None):
+    """Save text as a note, indexed with embedding if already computed."""
     note = await notes_service.create_note(
         user_id=user.id,
         note_data=NoteCreate(
             content=text,
             source="text"
-        )
+        ),
+        embedding=embedding
     )
     
-    # Index for RAG
-    await rag_service.index_note(str(note.id), text)
+    # Index for RAG in the background unless saved with the embedding
+    if embedding is None:
+        rag_service.enqueue_index(str(note.id), text)
     
     await message.answer("✅ Заметка сохранена!")
 
@@ -652,6 +853,9 @@ async def process_successful_payment(message: Message):
         )
         
         if success:
+            # Drop cached user/access so the new plan applies immediately
+            invalidate_user_caches(message.from_user.id, user_uuid)
+            
             # Get plan name for message
             plan_names = {
                 "pro": "Pro ⭐️",
@@ -688,14 +892,57 @@ async def process_successful_payment(message: Message):
 dp.include_router(router)
 
 
+# Webhook mode: Telegram pushes updates to the API server instead of the
+# bot long-polling. The secret is regenerated on every start along with
+# the webhook registration.
+WEBHOOK_PATH = "/api/telegram/webhook"
+WEBHOOK_SECRET = secrets.token_urlsafe(32)
+
+# How long shutdown waits for in-flight update handlers
+SHUTDOWN_GRACE_SECONDS = 10
+
+
+async def feed_webhook_update(body: bytes, secret_token: Optional[str]) -> bool:
+    """
+    Dispatch a webhook update in the background.
+    
+    Returns False if the request doesn't carry our secret token.
+    """
+    if not secret_token or not hmac.compare_digest(secret_token, WEBHOOK_SECRET):
+        return False
+    
+    update = Update.model_validate(orjson.loads(body), context={"bot": bot})
+    # Answer Telegram right away; handlers may take seconds (e.g. Whisper)
+    spawn(dp.feed_update(bot, update))
+    return True
+
+
 async def start_bot():
     """Start the bot."""
+    if settings.telegram_webhook_enabled and settings.public_url:
+        logger.info("Starting bot in webhook mode...")
+        await bot.set_webhook(
+            f"{settings.public_url}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        return
+    
     logger.info("Starting bot...")
+    # A webhook left over from webhook mode would block getUpdates
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 
 async def stop_bot():
     """Stop the bot."""
     logger.info("Stopping bot...")
+    if settings.telegram_webhook_enabled and settings.public_url:
+        # Let Telegram hold new updates until the next start sets the webhook
+        await bot.delete_webhook()
+    
+    # Finish updates (and usage writes) already handed to background tasks
+    if background_tasks:
+        await asyncio.wait(set(background_tasks), timeout=SHUTDOWN_GRACE_SECONDS)
     await bot.session.close()
 
@@ -1,3 +1,5 @@
+from functools import cached_property
+
 from pydantic_settings import BaseSettings
 from pydantic import field_validator
 from typing import List, Optional
@@ -7,6 +9,7 @@ class Settings(BaseSettings):
     # Telegram
     telegram_bot_token: str
     allowed_user_ids: str = ""  # Comma-separated list or empty
+    telegram_webhook_enabled: bool = False  # Receive updates via webhook (needs public_url)
     
     # Supabase
     supabase_url: str
@@ -16,14 +19,26 @@ class Settings(BaseSettings):
     # AI Services
     deepseek_api_key: str
     deepseek_api_url: str = "https://api.deepseek.com"
+    summary_model: str = "deepseek-chat"
+    rag_model: str = "deepseek-chat"
+    deepseek_max_concurrency: int = 10  # Parallel requests in summarize_many/ask_many
+    deepseek_rpm: int = 0  # Client-side requests per minute limit; 0 disables
+    summary_timeout: float = 8.0  # Seconds per summary request, retried once
+    rag_timeout: float = 15.0  # Seconds per RAG answer request/stream read, retried once
     openai_api_key: str  # For embeddings
+    rerank_model: str = ""  # Local cross-encoder for search rerank; empty disables
     
     # Whisper
     whisper_api_url: str = "http://whisper:9000"
     
+    # Outbound HTTP pool (shared by Whisper, DeepSeek and OpenAI clients)
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 64
+    
     # Server
     api_port: int = 8000
     public_url: str = ""  # For Mini App WebApp URL
+    profiling_enabled: bool = False  # Enables ?profile=1 pyinstrument reports
     
     @property
     def allowed_user_ids_list(self) -> List[int]:
@@ -35,6 +50,11 @@ class Settings(BaseSettings):
         except ValueError:
             return []
     
+    @cached_property
+    def allowed_user_ids_set(self) -> frozenset[int]:
+        """Allowed user IDs as a frozenset for O(1) membership checks."""
+        return frozenset(self.allowed_user_ids_list)
+    
     class Config:
         env_file = ".env"
         extra = "ignore"
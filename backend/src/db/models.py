@@ -96,6 +96,17 @@ class FTSSearchResult(BaseModel):
     rank: float
 
 
+class HybridSearchResult(BaseModel):
+    """Hybrid (FTS + semantic) search result model."""
+    id: UUID
+    content: str
+    summary: Optional[str] = None
+    created_at: datetime
+    score: float  # Reciprocal Rank Fusion score
+    similarity: Optional[float] = None  # Set if matched by semantic search
+    rank: Optional[float] = None  # Set if matched by full-text search
+
+
 class ShareResponse(BaseModel):
     """Share link response."""
     share_url: str
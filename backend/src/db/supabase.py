@@ -1,18 +1,52 @@
+import asyncio
+import logging
+
 from supabase import create_client, Client
+from supabase.lib.client_options import ClientOptions
 from ..config import settings
 
+logger = logging.getLogger(__name__)
+
+
+# Seconds before a PostgREST call gives up (library default is 120s); calls
+# are synchronous, so a hung request would stall the whole event loop
+POSTGREST_TIMEOUT = 10
 
 _client: Client | None = None
 
 
 def get_supabase_client() -> Client:
-    """Get or create Supabase client singleton."""
+    """
+    Get or create Supabase client singleton.
+    
+    Creation never awaits, so concurrent tasks on the event loop can't
+    race here and all services share one client and connection pool.
+    """
     global _client
     if _client is None:
         _client = create_client(
             settings.supabase_url,
-            settings.supabase_service_key
+            settings.supabase_service_key,
+            options=ClientOptions(postgrest_client_timeout=POSTGREST_TIMEOUT)
         )
     return _client
 
 
+async def execute_async(query):
+    """
+    Execute a PostgREST query builder in a worker thread.
+    
+    supabase-py is synchronous; running queries off the event loop keeps
+    one slow round trip from stalling every other update and request.
+    """
+    return await asyncio.to_thread(query.execute)
+
+
+async def warm_up_supabase() -> None:
+    """Open the PostgREST connection with a trivial query before serving."""
+    try:
+        await execute_async(
+            get_supabase_client().table("subscription_limits").select("plan").limit(1)
+        )
+    except Exception as e:
+        logger.warning(f"Supabase warm-up failed: {e}")
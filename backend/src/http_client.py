@@ -0,0 +1,34 @@
+import httpx
+
+from .config import settings
+
+
+_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get or create the shared outbound HTTP client singleton.
+    
+    One connection pool for Whisper, DeepSeek and OpenAI, so keep-alive
+    connections are reused across services; HTTP/2 is negotiated where
+    the server supports it. Timeouts are set per request by the callers.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=settings.http_max_connections,
+                max_keepalive_connections=settings.http_max_keepalive_connections
+            )
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -3,12 +3,19 @@ import logging
 import uvicorn
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from .config import settings
-from .api import router as api_router, set_bot_instance
-from .bot import start_bot, stop_bot, dp, bot
+from .api import router as api_router, set_bot_instance, TelegramAuthMiddleware, rag_service
+from .bot import (
+    start_bot, stop_bot, bot, rag_service as bot_rag_service,
+    feed_webhook_update, WEBHOOK_PATH
+)
+from .services.usage_buffer import usage_buffer
+from .http_client import close_http_client
+from .db.supabase import warm_up_supabase
 
 # Configure logging
 logging.basicConfig(
@@ -30,6 +37,9 @@ async def lifespan(app: FastAPI):
     # Pass bot instance to API for sending messages
     set_bot_instance(bot)
     
+    # Connect to Supabase now rather than on the first user's request
+    await warm_up_supabase()
+    
     # Start bot in background
     logger.info("Starting Telegram bot...")
     bot_task = asyncio.create_task(start_bot())
@@ -45,6 +55,10 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             pass
     await stop_bot()
+    await usage_buffer.close()
+    await rag_service.close()
+    await bot_rag_service.close()
+    await close_http_client()
 
 
 # Create main app with lifespan
@@ -52,18 +66,41 @@ app = FastAPI(
     title="Voice Notes",
     description="Voice Notes Telegram Bot + Mini App",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
-# CORS for Mini App
+# Telegram auth for /api routes (added before CORS so CORS wraps its errors)
+app.add_middleware(TelegramAuthMiddleware)
+
+# CORS for Mini App. Auth travels in a header, not cookies, so no credentials:
+# the wildcard origin is then a static header instead of echoing each Origin.
+# Preflights are cached by browsers for a day.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Content-Type", "X-Telegram-Init-Data"],
+    max_age=86400,
 )
 
+# Request profiling: append ?profile=1 to any URL to get a pyinstrument report
+if settings.profiling_enabled:
+    from fastapi.responses import HTMLResponse
+    from pyinstrument import Profiler
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        """Profile the request and return an HTML report instead of the response."""
+        if not request.query_params.get("profile"):
+            return await call_next(request)
+        
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        await call_next(request)
+        profiler.stop()
+        return HTMLResponse(profiler.output_html())
+
 # Include API router
 app.include_router(api_router)
 
@@ -84,12 +121,28 @@ async def health():
     return {"status": "ok"}
 
 
+@app.post(WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """Telegram webhook endpoint (webhook mode only)."""
+    accepted = await feed_webhook_update(
+        await request.body(),
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+    )
+    if not accepted:
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    return {"ok": True}
+
+
 def run():
     """Run the application."""
     uvicorn.run(
         "src.main:app",
         host="0.0.0.0",
         port=settings.api_port,
+        # uvloop/httptools ship with uvicorn[standard]; pin them explicitly
+        # so a missing extra fails loudly instead of silently falling back
+        loop="uvloop",
+        http="httptools",
         reload=False,
         log_level="info"
     )
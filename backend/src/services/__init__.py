@@ -3,12 +3,15 @@ from .notes_service import NotesService
 from .transcription import TranscriptionService
 from .summarizer import SummarizerService
 from .rag_service import RAGService
+from .usage_buffer import UsageBuffer, usage_buffer
 
 __all__ = [
     "NotesService",
     "TranscriptionService", 
     "SummarizerService",
-    "RAGService"
+    "RAGService",
+    "UsageBuffer",
+    "usage_buffer"
 ]
 
 
@@ -1,16 +1,78 @@
+import asyncio
+import itertools
 import logging
+import secrets
 from typing import Optional, List
 from uuid import UUID
 from datetime import datetime, timedelta
 
-from ..db.supabase import get_supabase_client
+from cachetools import TTLCache
+from postgrest.exceptions import APIError
+from pydantic import TypeAdapter
+
+from ..db.supabase import get_supabase_client, execute_async
 
 logger = logging.getLogger(__name__)
 from ..db.models import (
     User, UserCreate, Note, NoteCreate, NoteUpdate, StatsResponse, PublicNote, 
-    FTSSearchResult, SubscriptionInfo, SubscriptionLimits, UsageStats
+    FTSSearchResult, SubscriptionInfo
+)
+
+# Users by telegram_id, shared by the API and bot NotesService instances;
+# every bot update and API request resolves its user through this
+_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+
+# Per-user note stats and note list pages, shared by the API and bot
+# instances; dropped whenever that user's notes change
+_stats_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_notes_page_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+
+
+def _invalidate_notes_cache(user_id: UUID) -> None:
+    """Forget cached stats and note list pages for a user."""
+    uid = str(user_id)
+    _stats_cache.pop(uid, None)
+    _notes_page_cache.pop(uid, None)
+
+
+# Shared notes by share token (API share page and bot inline queries), plus
+# in-flight lookups so a burst of opens of a fresh link hits the DB once.
+# Entries are (sequence number at fetch start, result).
+_shared_note_cache: TTLCache = TTLCache(maxsize=4096, ttl=60)
+_shared_note_lookups: dict[str, asyncio.Future] = {}
+
+# Sequence number of each owner's latest note or share change. A shared note
+# is stale if its owner changed anything after its fetch started, which also
+# covers fetches still in flight while the change happens. Kept longer than
+# the cache TTL, so no live entry outlasts its owner's record.
+_shared_note_seq = itertools.count(1)
+_shared_note_changed: TTLCache = TTLCache(maxsize=100_000, ttl=300)
+
+
+def _invalidate_shared_notes(user_id: UUID) -> None:
+    """Mark a user's cached shared notes stale after a note or share change."""
+    _shared_note_changed[str(user_id)] = next(_shared_note_seq)
+
+
+def _is_shared_note_stale(fetched_at: int, result: dict) -> bool:
+    return _shared_note_changed.get(str(result["note"].user_id), 0) > fetched_at
+
+
+# Columns of the Note model; "*" would also ship the embedding vector
+# (~6-12KB per row) and the content_tsv search column
+NOTE_COLUMNS = (
+    "id, user_id, content, summary, source, duration_seconds, "
+    "share_token, is_public, created_at, updated_at"
 )
 
+# usage_stats counters that increment_usage may touch
+USAGE_FIELDS = frozenset({"summaries_used", "voice_seconds_used", "chat_messages_used"})
+
+# Validate whole result sets in one pydantic-core call instead of
+# constructing a model per row from Python
+NOTE_LIST_ADAPTER = TypeAdapter(List[Note])
+FTS_RESULT_LIST_ADAPTER = TypeAdapter(List[FTSSearchResult])
+
 
 class NotesService:
     """Service for managing notes and users."""
@@ -22,52 +84,45 @@ class NotesService:
     async def get_or_create_user(self, telegram_id: int, username: Optional[str] = None, 
                                   first_name: Optional[str] = None, 
                                   language_code: str = "ru") -> User:
-        """Get existing user or create new one."""
-        # Try to find existing user
-        result = self.client.table("users").select("*").eq(
-            "telegram_id", telegram_id
-        ).execute()
-        
-        if result.data:
-            user_data = result.data[0]
-            # Update user info if changed
-            updates = {}
-            if username and user_data.get("username") != username:
-                updates["username"] = username
-            if first_name and user_data.get("first_name") != first_name:
-                updates["first_name"] = first_name
-            
-            if updates:
-                result = self.client.table("users").update(updates).eq(
-                    "id", user_data["id"]
-                ).execute()
-                user_data = result.data[0]
-            
-            return User(**user_data)
-        
-        # Create new user
-        new_user = {
-            "telegram_id": telegram_id,
-            "username": username,
-            "first_name": first_name,
-            "language_code": language_code
-        }
-        result = self.client.table("users").insert(new_user).execute()
-        return User(**result.data[0])
+        """Get existing user or create new one, cached per telegram_id."""
+        cached = _user_cache.get(telegram_id)
+        if (
+            cached is not None
+            and (not username or cached.username == username)
+            and (not first_name or cached.first_name == first_name)
+        ):
+            return cached
+        
+        # Insert, update changed profile fields or just read, in one call
+        result = await execute_async(self.client.rpc("get_or_create_user", {
+            "p_telegram_id": telegram_id,
+            "p_username": username or None,
+            "p_first_name": first_name or None,
+            "p_language_code": language_code
+        }))
+        user = User(**result.data[0])
+        
+        _user_cache[telegram_id] = user
+        return user
+    
+    def invalidate_user(self, telegram_id: int) -> None:
+        """Drop a cached user, e.g. after a subscription change."""
+        _user_cache.pop(telegram_id, None)
     
     async def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
         """Get user by Telegram ID."""
-        result = self.client.table("users").select("*").eq(
+        result = await execute_async(self.client.table("users").select("*").eq(
             "telegram_id", telegram_id
-        ).execute()
+        ))
         
         if result.data:
             return User(**result.data[0])
         return None
     
     # Note operations
-    async def create_note(self, user_id: UUID, note_data: NoteCreate) -> Note:
-        """Create a new note."""
+    async def create_note(self, user_id: UUID, note_data: NoteCreate,
+                          embedding: Optional[List[float]] = None) -> Note:
+        """Create a new note, optionally already indexed with its embedding."""
         data = {
             "user_id": str(user_id),
             "content": note_data.content,
@@ -75,121 +130,179 @@ class NotesService:
             "source": note_data.source,
             "duration_seconds": note_data.duration_seconds
         }
-        result = self.client.table("notes").insert(data).execute()
+        if embedding is not None:
+            data["embedding"] = embedding
+        result = await execute_async(self.client.table("notes").insert(data))
+        _invalidate_notes_cache(user_id)
         return Note(**result.data[0])
     
-    async def get_note(self, note_id: UUID, user_id: UUID) -> Optional[Note]:
+    async def get_note(self, note_id: str | UUID, user_id: UUID) -> Optional[Note]:
         """Get a single note by ID."""
-        result = self.client.table("notes").select("*").eq(
+        result = await execute_async(self.client.table("notes").select(NOTE_COLUMNS).eq(
             "id", str(note_id)
-        ).eq("user_id", str(user_id)).execute()
+        ).eq("user_id", str(user_id)))
         
         if result.data:
             return Note(**result.data[0])
         return None
     
     async def get_notes(self, user_id: UUID, limit: int = 50, offset: int = 0) -> List[Note]:
-        """Get all notes for a user."""
-        result = self.client.table("notes").select("*").eq(
+        """Get all notes for a user (pages cached briefly)."""
+        notes, _ = await self.get_notes_page(user_id, limit=limit, offset=offset)
+        return notes
+    
+    async def get_notes_page(self, user_id: UUID, limit: int = 50,
+                             offset: int = 0) -> tuple[List[Note], int]:
+        """
+        Get a page of a user's notes together with their total count.
+        
+        The count comes back with the page in the same request, so listing
+        notes takes one round trip. Pages are cached briefly.
+        
+        Args:
+            user_id: Owner of the notes
+            limit: Page size
+            offset: Number of notes to skip
+            
+        Returns:
+            Notes on the page and the total number of the user's notes
+        """
+        uid = str(user_id)
+        pages = _notes_page_cache.get(uid)
+        if pages is not None and (limit, offset) in pages:
+            return pages[(limit, offset)]
+        
+        try:
+            result = await execute_async(self.client.table("notes").select(
+                NOTE_COLUMNS, count="exact"
+            ).eq("user_id", uid).order("created_at", desc=True).range(offset, offset + limit - 1))
+        except APIError as e:
+            # With an exact count, PostgREST rejects offsets past the end
+            if e.code != "PGRST103":
+                raise
+            return [], await self.count_notes(user_id)
+        
+        page = (NOTE_LIST_ADAPTER.validate_python(result.data), result.count or 0)
+        _notes_page_cache.setdefault(uid, {})[(limit, offset)] = page
+        return page
+    
+    async def count_notes(self, user_id: UUID) -> int:
+        """Count all notes for a user (server-side COUNT, no rows transferred)."""
+        result = await execute_async(self.client.table("notes").select("id", count="exact").eq(
             "user_id", str(user_id)
-        ).order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+        ).limit(1))
         
-        return [Note(**note) for note in result.data]
+        return result.count or 0
     
-    async def update_note(self, note_id: UUID, user_id: UUID, 
+    async def update_note(self, note_id: str | UUID, user_id: UUID, 
                           note_data: NoteUpdate) -> Optional[Note]:
         """Update a note."""
         updates = note_data.model_dump(exclude_unset=True)
         if not updates:
             return await self.get_note(note_id, user_id)
         
-        result = self.client.table("notes").update(updates).eq(
+        result = await execute_async(self.client.table("notes").update(updates).eq(
             "id", str(note_id)
-        ).eq("user_id", str(user_id)).execute()
+        ).eq("user_id", str(user_id)))
+        _invalidate_notes_cache(user_id)
+        _invalidate_shared_notes(user_id)
         
         if result.data:
             return Note(**result.data[0])
         return None
     
-    async def delete_note(self, note_id: UUID, user_id: UUID) -> bool:
+    async def delete_note(self, note_id: str | UUID, user_id: UUID) -> bool:
         """Delete a note."""
-        result = self.client.table("notes").delete().eq(
+        result = await execute_async(self.client.table("notes").delete().eq(
             "id", str(note_id)
-        ).eq("user_id", str(user_id)).execute()
+        ).eq("user_id", str(user_id)))
+        _invalidate_notes_cache(user_id)
+        _invalidate_shared_notes(user_id)
         
         return len(result.data) > 0
     
-    async def update_note_embedding(self, note_id: UUID, embedding: List[float]) -> bool:
+    async def update_note_embedding(self, note_id: str | UUID, embedding: List[float]) -> bool:
         """Update note embedding for RAG."""
-        result = self.client.table("notes").update({
+        result = await execute_async(self.client.table("notes").update({
             "embedding": embedding
-        }).eq("id", str(note_id)).execute()
+        }).eq("id", str(note_id)))
         
         return len(result.data) > 0
     
     async def get_stats(self, user_id: UUID) -> StatsResponse:
-        """Get statistics for a user."""
-        now = datetime.utcnow()
-        week_ago = now - timedelta(days=7)
-        month_ago = now - timedelta(days=30)
-        
-        # Get all notes count
-        all_notes = self.client.table("notes").select("id, source, created_at").eq(
-            "user_id", str(user_id)
-        ).execute()
-        
-        total = len(all_notes.data)
-        voice = sum(1 for n in all_notes.data if n["source"] == "voice")
-        text = total - voice
-        
-        this_week = sum(
-            1 for n in all_notes.data 
-            if datetime.fromisoformat(n["created_at"].replace("Z", "+00:00")).replace(tzinfo=None) > week_ago
-        )
-        this_month = sum(
-            1 for n in all_notes.data 
-            if datetime.fromisoformat(n["created_at"].replace("Z", "+00:00")).replace(tzinfo=None) > month_ago
-        )
-        
-        return StatsResponse(
-            total_notes=total,
-            voice_notes=voice,
-            text_notes=text,
-            notes_this_week=this_week,
-            notes_this_month=this_month
-        )
+        """Get statistics for a user (cached briefly)."""
+        uid = str(user_id)
+        cached = _stats_cache.get(uid)
+        if cached is not None:
+            return cached
+        
+        # Counts are aggregated in Postgres, a single row comes back
+        result = await execute_async(self.client.rpc("get_user_stats", {
+            "match_user_id": uid
+        }))
+        
+        stats = StatsResponse(**result.data[0])
+        _stats_cache[uid] = stats
+        return stats
 
     # Share operations
-    async def generate_share_token(self, note_id: UUID, user_id: UUID, is_public: bool = False) -> Optional[dict]:
+    async def generate_share_token(self, note_id: str | UUID, user_id: UUID, is_public: bool = False) -> Optional[dict]:
         """Generate or get share token for a note."""
-        # First check if note belongs to user
-        note = await self.get_note(note_id, user_id)
-        if not note:
+        # Set a new token unless the note already has one with the same
+        # public status, and read the result back, in one round trip
+        new_token = secrets.token_urlsafe(16)
+        result = await execute_async(self.client.rpc("share_note", {
+            "p_note_id": str(note_id),
+            "p_user_id": str(user_id),
+            "p_share_token": new_token,
+            "p_is_public": is_public
+        }))
+        
+        if not result.data:
             return None
         
-        # If already has token and same public status, return existing
-        if note.share_token and note.is_public == is_public:
-            return {"share_token": note.share_token, "is_public": note.is_public}
-        
-        # Generate new token using Python (more reliable than RPC)
-        import secrets
-        new_token = secrets.token_hex(16)
-        
-        # Update note
-        update_result = self.client.table("notes").update({
-            "share_token": new_token,
-            "is_public": is_public
-        }).eq("id", str(note_id)).eq("user_id", str(user_id)).execute()
-        
-        if update_result.data:
-            return {"share_token": new_token, "is_public": is_public}
-        return None
+        shared = result.data[0]
+        if shared["share_token"] == new_token:
+            _invalidate_notes_cache(user_id)
+            _invalidate_shared_notes(user_id)
+        return {"share_token": shared["share_token"], "is_public": shared["is_public"]}
 
     async def get_note_by_share_token(self, share_token: str) -> Optional[dict]:
-        """Get note by share token with ownership info."""
-        result = self.client.table("notes").select("*, users!inner(telegram_id)").eq(
+        """Get note by share token with ownership info (found notes cached briefly)."""
+        cached = _shared_note_cache.get(share_token)
+        if cached is not None:
+            fetched_at, result = cached
+            if not _is_shared_note_stale(fetched_at, result):
+                return result
+            _shared_note_cache.pop(share_token, None)
+        
+        lookup = _shared_note_lookups.get(share_token)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._fetch_and_cache_shared_note(share_token))
+            _shared_note_lookups[share_token] = lookup
+            lookup.add_done_callback(lambda _: _shared_note_lookups.pop(share_token, None))
+        
+        # Shielded so one cancelled request doesn't fail the others waiting
+        fetched_at, result = await asyncio.shield(lookup)
+        if result and _is_shared_note_stale(fetched_at, result):
+            # The owner changed notes while this read was in flight (e.g.
+            # revoked the link); don't serve what it saw, read again
+            result = await self._fetch_note_by_share_token(share_token)
+        return result
+    
+    async def _fetch_and_cache_shared_note(self, share_token: str) -> tuple[int, Optional[dict]]:
+        """Fetch a shared note and cache it unless its owner changed notes meanwhile."""
+        fetched_at = next(_shared_note_seq)
+        result = await self._fetch_note_by_share_token(share_token)
+        if result and not _is_shared_note_stale(fetched_at, result):
+            _shared_note_cache[share_token] = (fetched_at, result)
+        return fetched_at, result
+    
+    async def _fetch_note_by_share_token(self, share_token: str) -> Optional[dict]:
+        """Read a note and its owner's telegram_id by share token."""
+        result = await execute_async(self.client.table("notes").select(f"{NOTE_COLUMNS}, users!inner(telegram_id)").eq(
             "share_token", share_token
-        ).execute()
+        ))
         
         if result.data:
             note_data = result.data[0]
@@ -202,25 +315,27 @@ class NotesService:
             }
         return None
 
-    async def revoke_share_token(self, note_id: UUID, user_id: UUID) -> bool:
+    async def revoke_share_token(self, note_id: str | UUID, user_id: UUID) -> bool:
         """Revoke share token for a note."""
-        result = self.client.table("notes").update({
+        result = await execute_async(self.client.table("notes").update({
             "share_token": None,
             "is_public": False
-        }).eq("id", str(note_id)).eq("user_id", str(user_id)).execute()
+        }).eq("id", str(note_id)).eq("user_id", str(user_id)))
+        _invalidate_notes_cache(user_id)
+        _invalidate_shared_notes(user_id)
         
         return len(result.data) > 0
 
     # Full-text search
     async def search_notes_fts(self, user_id: UUID, query: str, limit: int = 20) -> List[FTSSearchResult]:
         """Full-text search notes."""
-        result = self.client.rpc("search_notes_fts", {
+        result = await execute_async(self.client.rpc("search_notes_fts", {
             "search_query": query,
             "match_user_id": str(user_id),
             "match_limit": limit
-        }).execute()
+        }))
         
-        return [FTSSearchResult(**r) for r in result.data]
+        return FTS_RESULT_LIST_ADAPTER.validate_python(result.data)
 
     # Subscription operations
     async def can_use_feature(self, user_id: UUID, feature: str) -> tuple[bool, str, str]:
@@ -268,95 +383,28 @@ class NotesService:
             return True, "unknown", "error"
 
     async def get_subscription_info(self, user_id: UUID) -> SubscriptionInfo:
-        """Get subscription info for a user."""
-        # Get user data
-        user_result = self.client.table("users").select("*").eq(
-            "id", str(user_id)
-        ).execute()
+        """Get subscription info for a user (expiry, limits and usage in one RPC)."""
+        result = await execute_async(self.client.rpc("get_subscription_snapshot", {
+            "p_user_id": str(user_id)
+        }))
         
-        if not user_result.data:
+        if not result.data:
             raise ValueError("User not found")
         
-        user_data = user_result.data[0]
-        plan = user_data.get("subscription_plan", "trial")
-        
-        # Check if trial expired
-        if plan == "trial":
-            trial_ends = user_data.get("trial_ends_at")
-            if trial_ends:
-                trial_ends_dt = datetime.fromisoformat(trial_ends.replace("Z", "+00:00")).replace(tzinfo=None)
-                if datetime.utcnow() > trial_ends_dt:
-                    # Update to free plan
-                    self.client.table("users").update({
-                        "subscription_plan": "free"
-                    }).eq("id", str(user_id)).execute()
-                    plan = "free"
-        
-        # Check if paid subscription expired
-        if plan in ("pro", "ultra"):
-            expires_at = user_data.get("subscription_expires_at")
-            if expires_at:
-                expires_dt = datetime.fromisoformat(expires_at.replace("Z", "+00:00")).replace(tzinfo=None)
-                if datetime.utcnow() > expires_dt:
-                    # Downgrade to free
-                    self.client.table("users").update({
-                        "subscription_plan": "free"
-                    }).eq("id", str(user_id)).execute()
-                    plan = "free"
-        
-        # Get plan limits
-        limits_result = self.client.table("subscription_limits").select("*").eq(
-            "plan", plan
-        ).execute()
-        
-        if limits_result.data:
-            limits_data = limits_result.data[0]
-            limits = SubscriptionLimits(
-                summaries_per_month=limits_data.get("summaries_per_month"),
-                voice_minutes_per_month=limits_data.get("voice_minutes_per_month"),
-                ai_chat_enabled=limits_data.get("ai_chat_enabled", False),
-                ai_chat_fast=limits_data.get("ai_chat_fast", False),
-                sync_enabled=limits_data.get("sync_enabled", False),
-                auto_sync=limits_data.get("auto_sync", False),
-                price_monthly_stars=limits_data.get("price_monthly_stars", 0),
-                price_yearly_stars=limits_data.get("price_yearly_stars", 0),
-            )
-        else:
-            limits = SubscriptionLimits()
-        
-        # Get current month usage
-        month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        usage_result = self.client.table("usage_stats").select("*").eq(
-            "user_id", str(user_id)
-        ).gte("month_start", month_start.isoformat()).execute()
-        
-        if usage_result.data:
-            usage_data = usage_result.data[0]
-            usage = UsageStats(
-                summaries_used=usage_data.get("summaries_used", 0),
-                voice_seconds_used=usage_data.get("voice_seconds_used", 0),
-                chat_messages_used=usage_data.get("chat_messages_used", 0),
-            )
-        else:
-            usage = UsageStats()
-        
-        return SubscriptionInfo(
-            plan=plan,
-            subscription_started_at=user_data.get("subscription_started_at"),
-            subscription_expires_at=user_data.get("subscription_expires_at"),
-            trial_started_at=user_data.get("trial_started_at"),
-            trial_ends_at=user_data.get("trial_ends_at"),
-            limits=limits,
-            usage=usage,
-        )
+        return SubscriptionInfo.model_validate(result.data)
 
     async def update_user_language(self, user_id: UUID, language: str) -> bool:
         """Update user's language preference."""
-        result = self.client.table("users").update({
+        result = await execute_async(self.client.table("users").update({
             "language_code": language
-        }).eq("id", str(user_id)).execute()
+        }).eq("id", str(user_id)))
         
-        return len(result.data) > 0
+        if not result.data:
+            return False
+        
+        # The cached User would keep the old language_code until it expires
+        self.invalidate_user(result.data[0]["telegram_id"])
+        return True
 
     async def activate_subscription(self, user_id: str | UUID, plan: str, billing_period: str) -> bool:
         """Activate a subscription for user."""
@@ -367,42 +415,25 @@ class NotesService:
         else:  # yearly
             expires_at = now + timedelta(days=365)
         
-        result = self.client.table("users").update({
+        result = await execute_async(self.client.table("users").update({
             "subscription_plan": plan,
             "subscription_started_at": now.isoformat(),
             "subscription_expires_at": expires_at.isoformat(),
-        }).eq("id", str(user_id)).execute()
+        }).eq("id", str(user_id)))
         
         return len(result.data) > 0
 
     async def increment_usage(self, user_id: UUID, usage_type: str, amount: int = 1) -> bool:
-        """Increment usage counter for a user."""
-        month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0).date()
+        """Increment usage counter for a user (atomic upsert, one round trip)."""
+        field = f"{usage_type}_used" if not usage_type.endswith("_used") else usage_type
+        if field not in USAGE_FIELDS:
+            logger.error(f"Unknown usage counter: {usage_type}")
+            return False
         
-        # Try to upsert usage record
         try:
-            # First try to get existing record
-            existing = self.client.table("usage_stats").select("*").eq(
-                "user_id", str(user_id)
-            ).eq("month_start", month_start.isoformat()).execute()
-            
-            if existing.data:
-                # Update existing
-                current = existing.data[0]
-                field = f"{usage_type}_used" if not usage_type.endswith("_used") else usage_type
-                new_value = current.get(field, 0) + amount
-                
-                result = self.client.table("usage_stats").update({
-                    field: new_value
-                }).eq("id", current["id"]).execute()
-            else:
-                # Create new
-                field = f"{usage_type}_used" if not usage_type.endswith("_used") else usage_type
-                result = self.client.table("usage_stats").insert({
-                    "user_id": str(user_id),
-                    "month_start": month_start.isoformat(),
-                    field: amount,
-                }).execute()
+            await execute_async(self.client.rpc("increment_usage_batch", {
+                "p_increments": [{"user_id": str(user_id), field: amount}]
+            }))
             
             return True
         except Exception:
@@ -1,23 +1,78 @@
+import asyncio
 import logging
+from array import array
+from functools import lru_cache
 from typing import List, Optional
-from uuid import UUID
+from cachetools import LRUCache
 from openai import AsyncOpenAI
+from pydantic import TypeAdapter
 
 from ..config import settings
-from ..db.supabase import get_supabase_client
+from ..http_client import get_http_client
+from ..db.supabase import get_supabase_client, execute_async
 from ..db.models import SearchResult
 
 logger = logging.getLogger(__name__)
 
+# Query embeddings by normalized query text, shared by every RAGService
+# instance (API and bot). Holds query embeddings only, never per-user results.
+# Entries are (exact embedded text, vector); vectors are kept as float32
+# arrays (~6 KiB each instead of ~48 KiB as a list of Python floats) and
+# turned back into lists on the way out.
+_query_embedding_cache: LRUCache = LRUCache(maxsize=10_000)
+
+
+def _query_cache_key(query: str) -> str:
+    """Normalize a query for the embedding cache (case and whitespace)."""
+    return " ".join(query.lower().split())
+
+
+# Validates a whole result set in one pydantic-core call
+SEARCH_RESULT_LIST_ADAPTER = TypeAdapter(List[SearchResult])
+
 
 class RAGService:
     """RAG service using OpenAI embeddings + Supabase pgvector."""
     
     def __init__(self):
-        self.openai = AsyncOpenAI(api_key=settings.openai_api_key)
+        self.openai = AsyncOpenAI(
+            api_key=settings.openai_api_key,
+            http_client=get_http_client()
+        )
         self.supabase = get_supabase_client()
         self.embedding_model = "text-embedding-3-small"
         self.embedding_dimensions = 1536
+        self.reranker = self._load_reranker(settings.rerank_model)
+        # Background indexing: (note_id, text) items embedded in batches
+        self.index_batch_size = 32
+        self.index_batch_window = 0.05
+        self._index_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        self._index_worker: Optional[asyncio.Task] = None
+        # Standalone index tasks (queue overflow); referenced until done so
+        # they aren't garbage-collected mid-flight
+        self._index_tasks: set[asyncio.Task] = set()
+    
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _load_reranker(model_name: str):
+        """
+        Load the optional local cross-encoder (requires sentence-transformers).
+        
+        Loaded once per process and shared by all RAGService instances.
+        """
+        if not model_name:
+            return None
+        try:
+            from sentence_transformers import CrossEncoder
+            return CrossEncoder(model_name)
+        except Exception as e:
+            logger.warning(f"Reranker disabled, failed to load {model_name}: {e}")
+            return None
+    
+    @property
+    def rerank_enabled(self) -> bool:
+        """Whether a cross-encoder reranker is loaded."""
+        return self.reranker is not None
     
     async def get_embedding(self, text: str) -> List[float]:
         """
@@ -44,6 +99,70 @@ class RAGService:
             logger.error(f"Embedding error: {e}")
             raise
     
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Get embedding vectors for several texts in a single API call.
+        
+        Args:
+            texts: Texts to embed
+            
+        Returns:
+            Embedding vectors in the same order as texts
+        """
+        max_chars = 30000
+        texts = [text[:max_chars] for text in texts]
+        
+        try:
+            response = await self.openai.embeddings.create(
+                model=self.embedding_model,
+                input=texts
+            )
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except Exception as e:
+            logger.error(f"Batch embedding error: {e}")
+            raise
+    
+    async def get_query_embedding(self, query: str) -> List[float]:
+        """
+        Get embedding for a search query, cached by normalized query text.
+        
+        Args:
+            query: Search query
+            
+        Returns:
+            Embedding vector (1536 dimensions)
+        """
+        key = _query_cache_key(query)
+        cached = _query_embedding_cache.get(key)
+        if cached is not None:
+            return cached[1].tolist()
+        
+        source = query.strip()
+        embedding = await self.get_embedding(source)
+        _query_embedding_cache[key] = (source, array("f", embedding))
+        return embedding
+    
+    def get_cached_query_embedding(self, query: str, exact: bool = False) -> Optional[List[float]]:
+        """
+        Get an already computed query embedding without calling the API.
+        
+        Args:
+            query: Search query
+            exact: Only return an embedding computed for exactly this
+                (stripped) text, not for a query differing in case or
+                spacing; required when the vector is stored for the text
+            
+        Returns:
+            Embedding vector, or None if not cached
+        """
+        cached = _query_embedding_cache.get(_query_cache_key(query))
+        if cached is None:
+            return None
+        source, embedding = cached
+        if exact and source != query.strip():
+            return None
+        return embedding.tolist()
+    
     async def index_note(self, note_id: str, text: str) -> bool:
         """
         Index a note with its embedding.
@@ -58,9 +177,9 @@ class RAGService:
         try:
             embedding = await self.get_embedding(text)
             
-            result = self.supabase.table("notes").update({
+            result = await execute_async(self.supabase.table("notes").update({
                 "embedding": embedding
-            }).eq("id", note_id).execute()
+            }).eq("id", note_id))
             
             logger.info(f"Note {note_id} indexed successfully")
             return len(result.data) > 0
@@ -69,6 +188,107 @@ class RAGService:
             logger.error(f"Index error for note {note_id}: {e}")
             return False
     
+    def enqueue_index(self, note_id: str, text: str) -> None:
+        """
+        Schedule a note for background indexing.
+        
+        Notes queued close together are embedded in one batched API call.
+        Falls back to a standalone index task if the queue is full.
+        """
+        if self._index_worker is None or self._index_worker.done():
+            self._index_worker = asyncio.create_task(self._run_index_worker())
+        
+        try:
+            self._index_queue.put_nowait((note_id, text))
+        except asyncio.QueueFull:
+            logger.warning(f"Index queue full, indexing note {note_id} directly")
+            task = asyncio.create_task(self.index_note(note_id, text))
+            self._index_tasks.add(task)
+            task.add_done_callback(self._index_tasks.discard)
+    
+    async def _run_index_worker(self):
+        """Drain the index queue in batches until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._index_queue.get()]
+            deadline = loop.time() + self.index_batch_window
+            while len(batch) < self.index_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._index_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                await self.index_notes_batch(
+                    [note_id for note_id, _ in batch], [text for _, text in batch]
+                )
+            finally:
+                for _ in batch:
+                    self._index_queue.task_done()
+    
+    async def index_notes_batch(self, note_ids: List[str], texts: List[str]) -> int:
+        """
+        Index several notes with one embeddings API call and one write.
+        
+        Args:
+            note_ids: UUIDs of the notes
+            texts: Text content to embed, in the same order
+            
+        Returns:
+            Number of notes indexed successfully
+        """
+        try:
+            embeddings = await self.get_embeddings(texts)
+        except Exception:
+            if len(note_ids) == 1:
+                return 0
+            # One bad input fails the whole request; retry the notes one by one
+            results = await asyncio.gather(*(
+                self.index_note(note_id, text) for note_id, text in zip(note_ids, texts)
+            ))
+            return sum(results)
+        
+        # Store the whole batch in one statement
+        try:
+            result = await execute_async(self.supabase.rpc("update_note_embeddings", {
+                "p_items": [
+                    {"id": note_id, "embedding": embedding}
+                    for note_id, embedding in zip(note_ids, embeddings)
+                ]
+            }))
+            indexed = result.data or 0
+        except Exception as e:
+            logger.error(f"Index error for notes {note_ids}: {e}")
+            return 0
+        
+        logger.info(f"Indexed {indexed}/{len(note_ids)} notes")
+        return indexed
+    
+    async def close(self) -> None:
+        """Stop the index worker, indexing whatever is still queued."""
+        if self._index_worker:
+            # Let the worker finish the batch it is embedding
+            try:
+                await asyncio.wait_for(self._index_queue.join(), timeout=10)
+            except asyncio.TimeoutError:
+                logger.warning("Index queue not drained in time")
+            self._index_worker.cancel()
+            self._index_worker = None
+        
+        if self._index_tasks:
+            await asyncio.gather(*self._index_tasks)
+        
+        batch = []
+        while not self._index_queue.empty():
+            batch.append(self._index_queue.get_nowait())
+        if batch:
+            await self.index_notes_batch(
+                [note_id for note_id, _ in batch], [text for _, text in batch]
+            )
+    
     async def search(self, query: str, user_id: str, limit: int = 5) -> List[SearchResult]:
         """
         Semantic search over user's notes.
@@ -83,24 +303,50 @@ class RAGService:
         """
         try:
             # Get query embedding
-            query_embedding = await self.get_embedding(query)
+            query_embedding = await self.get_query_embedding(query)
             
             # Call Supabase RPC function for similarity search
-            result = self.supabase.rpc("search_notes", {
+            result = await execute_async(self.supabase.rpc("search_notes", {
                 "query_embedding": query_embedding,
                 "match_count": limit,
                 "match_user_id": user_id
-            }).execute()
+            }))
             
             if not result.data:
                 return []
             
-            return [SearchResult(**item) for item in result.data]
+            return SEARCH_RESULT_LIST_ADAPTER.validate_python(result.data)
             
         except Exception as e:
             logger.error(f"Search error: {e}")
             return []
     
+    async def rerank(self, query: str, candidates: List[SearchResult]) -> List[SearchResult]:
+        """
+        Reorder candidates by cross-encoder relevance to the query.
+        
+        Args:
+            query: Search query
+            candidates: Candidates from vector search
+            
+        Returns:
+            Candidates sorted by relevance (unchanged if reranker is disabled)
+        """
+        if not self.reranker or len(candidates) < 2:
+            return candidates
+        
+        pairs = [(query, c.summary or c.content) for c in candidates]
+        try:
+            # Model inference is CPU-bound, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            scores = await loop.run_in_executor(None, self.reranker.predict, pairs)
+        except Exception as e:
+            logger.error(f"Rerank error: {e}")
+            return candidates
+        
+        ranked = sorted(zip(scores, candidates), key=lambda x: x[0], reverse=True)
+        return [c for _, c in ranked]
+    
     async def search_with_threshold(self, query: str, user_id: str, 
                                      limit: int = 5, 
                                      min_similarity: float = 0.3) -> List[SearchResult]:
@@ -120,13 +366,10 @@ class RAGService:
         return [r for r in results if r.similarity >= min_similarity]
     
     async def health_check(self) -> bool:
-        """Check if OpenAI API is available."""
+        """Check if OpenAI API is available (model metadata, no billed embedding)."""
         try:
-            response = await self.openai.embeddings.create(
-                model=self.embedding_model,
-                input="test"
-            )
-            return len(response.data) > 0
+            await self.openai.with_options(timeout=5.0).models.retrieve(self.embedding_model)
+            return True
         except Exception:
             return False
 
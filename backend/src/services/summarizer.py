@@ -1,33 +1,123 @@
+import asyncio
+import hashlib
+from array import array
 import logging
-from typing import Optional, List
+from typing import AsyncIterator, Awaitable, Optional, List, Sequence, Tuple
+from cachetools import LRUCache, TTLCache
 from openai import AsyncOpenAI
 
 from ..config import settings
+from ..http_client import get_http_client
+from ..rate_limit import TokenBucket
+from ..db.models import SearchResult
 
 logger = logging.getLogger(__name__)
 
 
-SUMMARY_SYSTEM_PROMPT = """Ты — AI-ассистент для создания кратких саммари голосовых заметок.
+SUMMARY_SYSTEM_PROMPT = """Сделай саммари заметки:
+1. 2-3 предложения, только ключевые идеи и факты
+2. Язык оригинала, ничего не добавляй
+3. Без вступлений
+"""
 
-Правила:
-1. Создавай краткое саммари на 2-3 предложения
-2. Сохраняй ключевые идеи и факты
-3. Используй тот же язык, что и в оригинале
-4. Не добавляй информацию, которой нет в тексте
-5. Начинай сразу с саммари, без вступлений типа "В этой заметке..."
+RAG_SYSTEM_PROMPT = """Отвечай на вопрос по заметкам пользователя:
+1. Только по контексту; если данных мало — так и скажи
+2. Язык вопроса, кратко
+3. Нет релевантных заметок — предложи создать заметку
 """
 
-RAG_SYSTEM_PROMPT = """Ты — AI-ассистент, который отвечает на вопросы пользователя на основе его заметок.
+NO_CONTEXT_ANSWER = "К сожалению, я не нашёл релевантных заметок для ответа на этот вопрос. Попробуйте переформулировать вопрос или создайте новую заметку с нужной информацией."
 
-Контекст из заметок пользователя будет предоставлен ниже. Используй только информацию из этого контекста для ответа.
+ASK_ERROR_ANSWER = "Произошла ошибка при генерации ответа. Попробуйте позже."
+
+# Texts shorter than this are already as short as a 2-3 sentence summary,
+# so they are not sent to the LLM at all
+MIN_SUMMARY_TEXT_LENGTH = 300
+
+# Summaries of identical transcripts (re-sent or forwarded voice messages),
+# keyed by a digest of the whitespace-normalized text
+_summary_cache: LRUCache = LRUCache(maxsize=2048)
+
+# Answers per exact set of context notes: a list of (normalized question,
+# question embedding, answer) entries. A new question over the same notes
+# reuses an answer when it is the same question up to case and spacing, or
+# when its embedding is at least ANSWER_CACHE_SIMILARITY close to a stored one.
+_answer_cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+ANSWER_CACHE_SIMILARITY = 0.95
+ANSWER_CACHE_PER_CONTEXT = 8
+
+# Client-side request rate limit shared by all SummarizerService instances,
+# so bursts queue here instead of turning into 429s and client backoff
+_rate_limiter: Optional[TokenBucket] = (
+    TokenBucket(settings.deepseek_rpm / 60, capacity=max(1, settings.deepseek_rpm // 10))
+    if settings.deepseek_rpm > 0 else None
+)
+
+# RAG context budget: prefill time grows with every input token
+CONTEXT_MAX_NOTES = 5
+CONTEXT_MAX_CHARS = 4000
+CONTEXT_MIN_SIMILARITY = 0.3
+CONTEXT_NOTE_CHARS = 500
+
+
+def _summary_cache_key(text: str) -> str:
+    return hashlib.sha256(" ".join(text.split()).encode()).hexdigest()
+
+
+async def _throttle() -> None:
+    if _rate_limiter is not None:
+        await _rate_limiter.acquire()
+
+
+def _note_context(note: SearchResult) -> str:
+    return note.summary or note.content[:CONTEXT_NOTE_CHARS]
+
+
+def _select_context(context_notes: List[SearchResult]) -> List[SearchResult]:
+    """Keep the most similar notes that fit the context budget."""
+    selected = []
+    total = 0
+    for note in sorted(context_notes, key=lambda note: note.similarity, reverse=True):
+        if note.similarity < CONTEXT_MIN_SIMILARITY or len(selected) == CONTEXT_MAX_NOTES:
+            break
+        total += len(_note_context(note))
+        if selected and total > CONTEXT_MAX_CHARS:
+            break
+        selected.append(note)
+    return selected
 
-Правила:
-1. Отвечай только на основе предоставленного контекста
-2. Если информации недостаточно, честно скажи об этом
-3. Отвечай на том же языке, на котором задан вопрос
-4. Будь кратким и информативным
-5. Если релевантных заметок нет, предложи создать новую заметку
-"""
+
+def _context_key(context_notes: List[SearchResult]) -> Tuple:
+    return tuple(sorted((str(note.id), _note_context(note)) for note in context_notes))
+
+
+def _similarity(a: Sequence[float], b: Sequence[float]) -> float:
+    # OpenAI embeddings are unit length, so the dot product is the cosine
+    return sum(x * y for x, y in zip(a, b))
+
+
+def _normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+def _lookup_answer(key: Tuple, question: str, embedding: Optional[Sequence[float]]) -> Optional[str]:
+    for cached_question, cached_embedding, answer in _answer_cache.get(key, ()):
+        if cached_question == question:
+            return answer
+        if (embedding is not None and cached_embedding is not None
+                and _similarity(embedding, cached_embedding) >= ANSWER_CACHE_SIMILARITY):
+            return answer
+    return None
+
+
+def _store_answer(key: Tuple, question: str, embedding: Optional[List[float]], answer: str) -> None:
+    # Own float32 copy: ~6 KiB instead of ~48 KiB for a list of floats, and
+    # not shared with the query embedding cache
+    if embedding is not None:
+        embedding = array("f", embedding)
+    entries = _answer_cache.get(key, [])
+    _answer_cache[key] = [(question, embedding, answer)] + entries[:ANSWER_CACHE_PER_CONTEXT - 1]
 
 
 class SummarizerService:
@@ -36,9 +126,19 @@ class SummarizerService:
     def __init__(self):
         self.client = AsyncOpenAI(
             api_key=settings.deepseek_api_key,
-            base_url=settings.deepseek_api_url
+            base_url=settings.deepseek_api_url,
+            http_client=get_http_client()
         )
-        self.model = "deepseek-chat"
+        # Routed per task so summaries can move to a cheaper model on their own
+        self.summary_model = settings.summary_model
+        self.rag_model = settings.rag_model
+        # Tail latency is far above the median, so give up on a slow request
+        # early and retry once (the openai client retries timeouts itself)
+        # instead of waiting out the default 10 minute timeout
+        self._summary_client = self.client.with_options(timeout=settings.summary_timeout, max_retries=1)
+        self._rag_client = self.client.with_options(timeout=settings.rag_timeout, max_retries=1)
+        # Bounds the batch helpers below to the account's rate limit
+        self._batch_semaphore = asyncio.Semaphore(settings.deepseek_max_concurrency)
     
     async def summarize(self, text: str) -> Optional[str]:
         """
@@ -48,83 +148,181 @@ class SummarizerService:
             text: Text to summarize
             
         Returns:
-            Summary or None if failed
+            Summary, or None if failed or the text is too short to need one
         """
-        if not text or len(text.strip()) < 20:
+        if not text or len(text.strip()) < MIN_SUMMARY_TEXT_LENGTH:
             return None
+        
+        key = _summary_cache_key(text)
+        cached = _summary_cache.get(key)
+        if cached is not None:
+            logger.info("Summary cache hit")
+            return cached
             
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
+            await _throttle()
+            response = await self._summary_client.chat.completions.create(
+                model=self.summary_model,
                 messages=[
                     {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
                     {"role": "user", "content": f"Создай краткое саммари:\n\n{text}"}
                 ],
-                max_tokens=500,
-                temperature=0.3
+                max_tokens=220,
+                temperature=0.2
             )
             
-            summary = response.choices[0].message.content
+            summary = response.choices[0].message.content.strip()
             logger.info(f"Summary created: {len(summary)} chars")
-            return summary.strip()
+            _summary_cache[key] = summary
+            return summary
             
         except Exception as e:
             logger.error(f"Summarization error: {e}")
             return None
     
-    async def ask(self, question: str, context_notes: List[dict]) -> str:
+    def _rag_messages(self, question: str, context_notes: List[SearchResult]) -> List[dict]:
+        """Build the chat messages for a RAG answer."""
+        # DeepSeek caches prompt prefixes on its side: a request whose leading
+        # tokens are byte-identical to an earlier one skips their prefill.
+        # Keep everything that repeats first (system prompt, then the notes
+        # in a fixed order with no per-query similarity scores) and the
+        # question last, so follow-up questions over the same notes reuse it.
+        notes = sorted(context_notes, key=lambda note: str(note.id))
+        context = "\n\n".join(
+            f"[Заметка {i}]\n{_note_context(note)}"
+            for i, note in enumerate(notes, 1)
+        )
+        
+        return [
+            {"role": "system", "content": RAG_SYSTEM_PROMPT},
+            {"role": "system", "content": f"Контекст из заметок:\n\n{context}"},
+            {"role": "user", "content": question}
+        ]
+    
+    async def ask_stream(
+        self,
+        question: str,
+        context_notes: List[SearchResult],
+        query_embedding: Optional[List[float]] = None
+    ) -> AsyncIterator[str]:
         """
-        Answer a question based on context from notes.
+        Stream an answer to a question based on context from notes.
         
         Args:
             question: User's question
-            context_notes: List of relevant notes with content and similarity
+            context_notes: Relevant notes from RAG search
+            query_embedding: Embedding of the question; also reuses answers to
+                paraphrased questions over the same notes
             
-        Returns:
-            AI response
+        Yields:
+            Answer text chunks as DeepSeek produces them
         """
+        # Pick notes by relevance; _rag_messages then renders them in a
+        # stable order for prefix caching
+        context_notes = _select_context(context_notes)
         if not context_notes:
-            return "К сожалению, я не нашёл релевантных заметок для ответа на этот вопрос. Попробуйте переформулировать вопрос или создайте новую заметку с нужной информацией."
+            yield NO_CONTEXT_ANSWER
+            return
         
-        # Build context from notes
-        context_parts = []
-        for i, note in enumerate(context_notes, 1):
-            content = note.get("content", "")
-            summary = note.get("summary", "")
-            similarity = note.get("similarity", 0)
-            
-            text = summary if summary else content[:500]
-            context_parts.append(f"[Заметка {i}] (релевантность: {similarity:.0%})\n{text}")
-        
-        context = "\n\n".join(context_parts)
+        key = _context_key(context_notes)
+        normalized_question = _normalize_question(question)
+        cached = _lookup_answer(key, normalized_question, query_embedding)
+        if cached is not None:
+            logger.info("RAG answer cache hit")
+            yield cached
+            return
         
+        parts = []
+        length = 0
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": RAG_SYSTEM_PROMPT},
-                    {"role": "user", "content": f"Контекст из заметок:\n\n{context}\n\n---\n\nВопрос: {question}"}
-                ],
-                max_tokens=1000,
-                temperature=0.5
+            await _throttle()
+            stream = await self._rag_client.chat.completions.create(
+                model=self.rag_model,
+                messages=self._rag_messages(question, context_notes),
+                max_tokens=600,
+                temperature=0.5,
+                stream=True
             )
             
-            answer = response.choices[0].message.content
-            logger.info(f"RAG answer created: {len(answer)} chars")
-            return answer.strip()
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    length += len(delta)
+                    yield delta
+            
+            logger.info(f"RAG answer streamed: {length} chars")
+            if length:
+                _store_answer(key, normalized_question, query_embedding, "".join(parts).strip())
             
         except Exception as e:
             logger.error(f"RAG error: {e}")
-            return "Произошла ошибка при генерации ответа. Попробуйте позже."
+            # Only replace the answer if nothing has been produced yet
+            if not length:
+                yield ASK_ERROR_ANSWER
+    
+    async def ask(
+        self,
+        question: str,
+        context_notes: List[SearchResult],
+        query_embedding: Optional[List[float]] = None
+    ) -> str:
+        """
+        Answer a question based on context from notes.
+        
+        Args:
+            question: User's question
+            context_notes: Relevant notes from RAG search
+            query_embedding: Embedding of the question, see ask_stream
+            
+        Returns:
+            AI response
+        """
+        parts = [delta async for delta in self.ask_stream(question, context_notes, query_embedding)]
+        return "".join(parts).strip()
+    
+    async def _bounded(self, call: Awaitable):
+        async with self._batch_semaphore:
+            return await call
+    
+    async def summarize_many(self, texts: List[str]) -> List[Optional[str]]:
+        """
+        Summarize several texts concurrently.
+        
+        Args:
+            texts: Texts to summarize
+            
+        Returns:
+            Summaries in the same order, None where summarization failed
+        """
+        return await asyncio.gather(*(self._bounded(self.summarize(text)) for text in texts))
+    
+    async def ask_many(
+        self,
+        questions: List[str],
+        context_notes: List[List[SearchResult]]
+    ) -> List[str]:
+        """
+        Answer several questions concurrently.
+        
+        Args:
+            questions: User questions
+            context_notes: Relevant notes for each question, in the same order
+            
+        Returns:
+            AI responses in the same order
+        """
+        return await asyncio.gather(*(
+            self._bounded(self.ask(question, notes))
+            for question, notes in zip(questions, context_notes)
+        ))
     
     async def health_check(self) -> bool:
-        """Check if DeepSeek API is available."""
+        """Check if DeepSeek API is available (model list, no billed completion)."""
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": "Hi"}],
-                max_tokens=5
-            )
+            await self.client.with_options(timeout=5.0).models.list()
             return True
         except Exception:
             return False
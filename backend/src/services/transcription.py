@@ -1,12 +1,30 @@
+import hashlib
 import httpx
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Optional
+from cachetools import LRUCache
 
 from ..config import settings
+from ..http_client import get_http_client
 
 logger = logging.getLogger(__name__)
 
+# Transcripts keyed by (audio digest, language): a retried or re-sent voice
+# message is answered without running Whisper again
+_transcript_cache: LRUCache = LRUCache(maxsize=1024)
+
+HASH_CHUNK_SIZE = 1 << 16
+
+
+def _audio_digest(audio_file: BinaryIO) -> str:
+    """Hash the audio in chunks and rewind the file for the upload."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: audio_file.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    audio_file.seek(0)
+    return digest.hexdigest()
+
 
 class TranscriptionService:
     """Service for transcribing audio files using Whisper API."""
@@ -14,6 +32,7 @@ class TranscriptionService:
     def __init__(self):
         self.api_url = settings.whisper_api_url
         self.timeout = httpx.Timeout(120.0, connect=10.0)
+        self.client = get_http_client()
     
     async def transcribe(self, audio_path: str, language: str = "ru") -> Optional[str]:
         """
@@ -26,45 +45,16 @@ class TranscriptionService:
         Returns:
             Transcribed text or None if failed
         """
-        try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                with open(audio_path, "rb") as audio_file:
-                    files = {
-                        "audio_file": (Path(audio_path).name, audio_file, "audio/ogg")
-                    }
-                    params = {
-                        "language": language,
-                        "output": "txt"
-                    }
-                    
-                    response = await client.post(
-                        f"{self.api_url}/asr",
-                        files=files,
-                        params=params
-                    )
-                    
-                    if response.status_code == 200:
-                        text = response.text.strip()
-                        logger.info(f"Transcription successful: {len(text)} chars")
-                        return text
-                    else:
-                        logger.error(f"Transcription failed: {response.status_code} - {response.text}")
-                        return None
-                        
-        except httpx.TimeoutException:
-            logger.error("Transcription timeout")
-            return None
-        except Exception as e:
-            logger.error(f"Transcription error: {e}")
-            return None
+        with open(audio_path, "rb") as audio_file:
+            return await self.transcribe_file(audio_file, Path(audio_path).name, language)
     
-    async def transcribe_bytes(self, audio_data: bytes, filename: str = "audio.ogg",
-                                language: str = "ru") -> Optional[str]:
+    async def transcribe_file(self, audio_file: BinaryIO, filename: str = "audio.ogg",
+                              language: str = "ru") -> Optional[str]:
         """
-        Transcribe audio from bytes.
+        Transcribe audio from an open binary file, uploaded in chunks.
         
         Args:
-            audio_data: Audio file bytes
+            audio_file: File object positioned at the start of the audio
             filename: Filename for the upload
             language: Language code for transcription
             
@@ -72,29 +62,37 @@ class TranscriptionService:
             Transcribed text or None if failed
         """
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                files = {
-                    "audio_file": (filename, audio_data, "audio/ogg")
-                }
-                params = {
-                    "language": language,
-                    "output": "txt"
-                }
-                
-                response = await client.post(
-                    f"{self.api_url}/asr",
-                    files=files,
-                    params=params
-                )
+            key = (_audio_digest(audio_file), language)
+            cached = _transcript_cache.get(key)
+            if cached is not None:
+                logger.info("Transcription cache hit")
+                return cached
+            
+            files = {
+                "audio_file": (filename, audio_file, "audio/ogg")
+            }
+            params = {
+                "language": language,
+                "output": "txt"
+            }
+            
+            response = await self.client.post(
+                f"{self.api_url}/asr",
+                files=files,
+                params=params,
+                timeout=self.timeout
+            )
+            
+            if response.status_code == 200:
+                text = response.text.strip()
+                logger.info(f"Transcription successful: {len(text)} chars")
+                if text:
+                    _transcript_cache[key] = text
+                return text
+            else:
+                logger.error(f"Transcription failed: {response.status_code} - {response.text}")
+                return None
                 
-                if response.status_code == 200:
-                    text = response.text.strip()
-                    logger.info(f"Transcription successful: {len(text)} chars")
-                    return text
-                else:
-                    logger.error(f"Transcription failed: {response.status_code} - {response.text}")
-                    return None
-                    
         except httpx.TimeoutException:
             logger.error("Transcription timeout")
             return None
@@ -105,9 +103,8 @@ class TranscriptionService:
     async def health_check(self) -> bool:
         """Check if Whisper service is available."""
         try:
-            async with httpx.AsyncClient(timeout=httpx.Timeout(5.0)) as client:
-                response = await client.get(f"{self.api_url}/")
-                return response.status_code == 200
+            response = await self.client.get(f"{self.api_url}/", timeout=5.0)
+            return response.status_code == 200
         except Exception:
             return False
 
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Optional
+from uuid import UUID
+
+from ..db.supabase import get_supabase_client, execute_async
+
+logger = logging.getLogger(__name__)
+
+
+class UsageBuffer:
+    """
+    Coalesces usage counter increments in memory and writes them in batches.
+    
+    The first increment after a flush schedules the next flush, so all
+    increments arriving within the window share one RPC round-trip.
+    """
+    
+    def __init__(self, flush_interval: float = 0.2, max_pending: int = 500):
+        self.client = get_supabase_client()
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # user_id -> {"chat_messages_used": n, ...}
+        self._pending: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._task: Optional[asyncio.Task] = None
+        # Early flushes in flight; referenced so they aren't garbage-collected
+        self._flush_tasks: set[asyncio.Task] = set()
+    
+    def add(self, user_id: UUID, usage_type: str, amount: int = 1) -> None:
+        """Buffer an increment of a usage counter."""
+        field = f"{usage_type}_used" if not usage_type.endswith("_used") else usage_type
+        self._pending[str(user_id)][field] += amount
+        
+        if len(self._pending) >= self.max_pending:
+            task = asyncio.create_task(self.flush())
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+        elif self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+    
+    async def _flush_later(self):
+        """Flush after the coalescing window."""
+        await asyncio.sleep(self.flush_interval)
+        self._task = None
+        await self.flush()
+    
+    async def flush(self) -> None:
+        """Write all pending increments in a single RPC call."""
+        if not self._pending:
+            return
+        
+        pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+        increments = [
+            {"user_id": user_id, **counters}
+            for user_id, counters in pending.items()
+        ]
+        
+        try:
+            await execute_async(self.client.rpc("increment_usage_batch", {
+                "p_increments": increments
+            }))
+        except Exception as e:
+            logger.error(f"Usage flush error ({len(increments)} users): {e}")
+    
+    async def close(self) -> None:
+        """Cancel the scheduled flush, wait for early ones and write what is pending."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks)
+        await self.flush()
+
+
+usage_buffer = UsageBuffer()
@@ -0,0 +1,24 @@
+-- Batched usage counter increments
+-- Applies many per-user increments in a single atomic statement
+
+CREATE OR REPLACE FUNCTION increment_usage_batch(p_increments JSONB)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- p_increments: [{"user_id": "...", "summaries_used": 1, ...}, ...]
+    -- At most one element per user_id (ON CONFLICT can't touch a row twice)
+    INSERT INTO usage_stats (user_id, month_start, summaries_used, voice_seconds_used, chat_messages_used)
+    SELECT
+        (e->>'user_id')::UUID,
+        DATE_TRUNC('month', NOW())::DATE,
+        COALESCE((e->>'summaries_used')::INTEGER, 0),
+        COALESCE((e->>'voice_seconds_used')::INTEGER, 0),
+        COALESCE((e->>'chat_messages_used')::INTEGER, 0)
+    FROM jsonb_array_elements(p_increments) AS e
+    ON CONFLICT (user_id, month_start) DO UPDATE SET
+        summaries_used = usage_stats.summaries_used + EXCLUDED.summaries_used,
+        voice_seconds_used = usage_stats.voice_seconds_used + EXCLUDED.voice_seconds_used,
+        chat_messages_used = usage_stats.chat_messages_used + EXCLUDED.chat_messages_used;
+END;
+$$;
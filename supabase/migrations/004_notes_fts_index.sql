@@ -0,0 +1,55 @@
+-- Full-text search index for notes
+-- Stores a precomputed tsvector and indexes it with GIN so search_notes_fts
+-- is an index lookup instead of a per-row to_tsvector sequential scan
+
+-- More memory speeds up the GIN build for the backfill
+SET maintenance_work_mem = '256MB';
+
+ALTER TABLE notes
+ADD COLUMN IF NOT EXISTS content_tsv tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('russian', coalesce(content, '') || ' ' || coalesce(summary, ''))
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_notes_content_tsv ON notes USING GIN (content_tsv);
+
+RESET maintenance_work_mem;
+
+-- Function for full-text search
+DROP FUNCTION IF EXISTS search_notes_fts(TEXT, UUID, INT);
+CREATE OR REPLACE FUNCTION search_notes_fts(
+    search_query TEXT,
+    match_user_id UUID,
+    match_limit INT DEFAULT 20
+)
+RETURNS TABLE (
+    id UUID,
+    content TEXT,
+    summary TEXT,
+    source VARCHAR,
+    duration_seconds INTEGER,
+    created_at TIMESTAMPTZ,
+    rank REAL
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_query tsquery := plainto_tsquery('russian', search_query);
+BEGIN
+    RETURN QUERY
+    SELECT
+        n.id,
+        n.content,
+        n.summary,
+        n.source,
+        n.duration_seconds,
+        n.created_at,
+        ts_rank(n.content_tsv, v_query) AS rank
+    FROM notes n
+    WHERE
+        n.user_id = match_user_id
+        AND n.content_tsv @@ v_query
+    ORDER BY ts_rank(n.content_tsv, v_query) DESC
+    LIMIT match_limit;
+END;
+$$;
@@ -0,0 +1,23 @@
+-- Note statistics aggregated in the database
+-- Returns one row of counts instead of sending every note row to the client
+
+CREATE OR REPLACE FUNCTION get_user_stats(match_user_id UUID)
+RETURNS TABLE (
+    total_notes BIGINT,
+    voice_notes BIGINT,
+    text_notes BIGINT,
+    notes_this_week BIGINT,
+    notes_this_month BIGINT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT
+        COUNT(*),
+        COUNT(*) FILTER (WHERE n.source = 'voice'),
+        COUNT(*) FILTER (WHERE n.source IS DISTINCT FROM 'voice'),
+        COUNT(*) FILTER (WHERE n.created_at > NOW() - INTERVAL '7 days'),
+        COUNT(*) FILTER (WHERE n.created_at > NOW() - INTERVAL '30 days')
+    FROM notes n
+    WHERE n.user_id = match_user_id;
+$$;
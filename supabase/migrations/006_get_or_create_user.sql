@@ -0,0 +1,35 @@
+-- Get or create a user in one round trip
+-- Inserts new users, writes changed profile fields for existing ones and
+-- returns the row; unchanged users are read without an UPDATE
+
+CREATE OR REPLACE FUNCTION get_or_create_user(
+    p_telegram_id BIGINT,
+    p_username VARCHAR DEFAULT NULL,
+    p_first_name VARCHAR DEFAULT NULL,
+    p_language_code VARCHAR DEFAULT 'ru'
+)
+RETURNS SETOF users
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_user users;
+BEGIN
+    -- NULL profile fields never overwrite stored ones, and language_code is
+    -- only set on insert (users change it from the Mini App)
+    INSERT INTO users (telegram_id, username, first_name, language_code)
+    VALUES (p_telegram_id, p_username, p_first_name, p_language_code)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        username = COALESCE(EXCLUDED.username, users.username),
+        first_name = COALESCE(EXCLUDED.first_name, users.first_name)
+    WHERE
+        (EXCLUDED.username IS NOT NULL AND users.username IS DISTINCT FROM EXCLUDED.username)
+        OR (EXCLUDED.first_name IS NOT NULL AND users.first_name IS DISTINCT FROM EXCLUDED.first_name)
+    RETURNING * INTO v_user;
+    
+    IF NOT FOUND THEN
+        SELECT * INTO v_user FROM users WHERE telegram_id = p_telegram_id;
+    END IF;
+    
+    RETURN NEXT v_user;
+END;
+$$;
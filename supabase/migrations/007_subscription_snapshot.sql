@@ -0,0 +1,53 @@
+-- Subscription info in one round trip
+-- Applies plan expiry and returns plan, limits and current month usage as
+-- a JSON object shaped like the API's SubscriptionInfo
+
+CREATE OR REPLACE FUNCTION get_subscription_snapshot(p_user_id UUID)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_user users;
+    v_limits subscription_limits;
+    v_usage usage_stats;
+BEGIN
+    SELECT * INTO v_user FROM users WHERE id = p_user_id;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+    
+    -- Check if trial expired
+    IF v_user.subscription_plan = 'trial' AND v_user.trial_ends_at < NOW() THEN
+        UPDATE users SET subscription_plan = 'free' WHERE id = p_user_id;
+        v_user.subscription_plan := 'free';
+    END IF;
+    
+    -- Check if subscription expired (for paid plans)
+    IF v_user.subscription_plan IN ('pro', 'ultra') AND v_user.subscription_expires_at < NOW() THEN
+        UPDATE users SET subscription_plan = 'free' WHERE id = p_user_id;
+        v_user.subscription_plan := 'free';
+    END IF;
+    
+    SELECT * INTO v_limits FROM subscription_limits WHERE plan = v_user.subscription_plan;
+    
+    SELECT * INTO v_usage FROM usage_stats
+    WHERE user_id = p_user_id AND month_start >= DATE_TRUNC('month', NOW())::DATE
+    ORDER BY month_start
+    LIMIT 1;
+    
+    -- NULL limits/usage fields are dropped so the API model defaults apply
+    RETURN jsonb_build_object(
+        'plan', v_user.subscription_plan,
+        'subscription_started_at', v_user.subscription_started_at,
+        'subscription_expires_at', v_user.subscription_expires_at,
+        'trial_started_at', v_user.trial_started_at,
+        'trial_ends_at', v_user.trial_ends_at,
+        'limits', jsonb_strip_nulls(to_jsonb(v_limits) - 'plan'),
+        'usage', jsonb_strip_nulls(jsonb_build_object(
+            'summaries_used', v_usage.summaries_used,
+            'voice_seconds_used', v_usage.voice_seconds_used,
+            'chat_messages_used', v_usage.chat_messages_used
+        ))
+    );
+END;
+$$;
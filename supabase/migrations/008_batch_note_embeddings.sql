@@ -0,0 +1,20 @@
+-- Batched note embedding writes
+-- Stores the embeddings of a whole indexing batch in a single statement
+
+CREATE OR REPLACE FUNCTION update_note_embeddings(p_items JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_count INTEGER;
+BEGIN
+    -- p_items: [{"id": "...", "embedding": [0.1, ...]}, ...]
+    UPDATE notes n
+    SET embedding = (e->>'embedding')::extensions.vector
+    FROM jsonb_array_elements(p_items) AS e
+    WHERE n.id = (e->>'id')::UUID;
+    
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
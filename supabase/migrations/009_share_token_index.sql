@@ -0,0 +1,10 @@
+-- Share token lookups
+-- Shared notes and inline share queries look notes up by share_token;
+-- index it so those reads don't scan the notes table
+
+ALTER TABLE notes
+ADD COLUMN IF NOT EXISTS share_token TEXT,
+ADD COLUMN IF NOT EXISTS is_public BOOLEAN DEFAULT false;
+
+CREATE INDEX IF NOT EXISTS idx_notes_share_token ON notes(share_token)
+    WHERE share_token IS NOT NULL;
@@ -0,0 +1,45 @@
+-- Similarity search computing each distance once
+-- The previous version evaluated the 1536-dim cosine distance twice per
+-- row (for the similarity column and for ORDER BY). Search stays exact over
+-- the user's notes: with a per-user filter an HNSW index would post-filter
+-- and lose recall, while the user_id index keeps the scan to their rows.
+
+CREATE OR REPLACE FUNCTION search_notes(
+    query_embedding extensions.vector(1536),
+    match_count INT DEFAULT 5,
+    match_user_id UUID DEFAULT NULL
+)
+RETURNS TABLE (
+    id UUID,
+    content TEXT,
+    summary TEXT,
+    similarity FLOAT,
+    created_at TIMESTAMPTZ
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        s.id,
+        s.content,
+        s.summary,
+        1 - s.distance AS similarity,
+        s.created_at
+    FROM (
+        SELECT
+            n.id,
+            n.content,
+            n.summary,
+            n.created_at,
+            n.embedding <=> query_embedding AS distance
+        FROM notes n
+        WHERE
+            (match_user_id IS NULL OR n.user_id = match_user_id)
+            AND n.embedding IS NOT NULL
+        ORDER BY distance
+        LIMIT match_count
+    ) s
+    ORDER BY s.distance;
+END;
+$$;
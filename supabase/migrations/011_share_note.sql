@@ -0,0 +1,28 @@
+-- Share a note in one round trip
+-- Sets a new share token unless the note already has one with the same
+-- public status, and returns the note's current token and status; returns
+-- no row if the note doesn't belong to the user
+
+CREATE OR REPLACE FUNCTION share_note(
+    p_note_id UUID,
+    p_user_id UUID,
+    p_share_token TEXT,
+    p_is_public BOOLEAN DEFAULT false
+)
+RETURNS TABLE (share_token TEXT, is_public BOOLEAN)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE notes n
+    SET share_token = p_share_token,
+        is_public = p_is_public
+    WHERE n.id = p_note_id
+        AND n.user_id = p_user_id
+        AND (n.share_token IS NULL OR n.is_public IS DISTINCT FROM p_is_public);
+    
+    RETURN QUERY
+    SELECT n.share_token, n.is_public
+    FROM notes n
+    WHERE n.id = p_note_id AND n.user_id = p_user_id;
+END;
+$$;